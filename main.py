@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from pydantic import BaseModel
 import requests
 import json
@@ -8,9 +8,15 @@ from googleapiclient.discovery import build
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from io import BytesIO
 import time
+import random
 import asyncio
+import fcntl
 import logging
-from contextlib import asynccontextmanager
+import sqlite3
+import threading
+import uuid
+from contextlib import asynccontextmanager, closing, contextmanager
+import numpy as np
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +38,35 @@ open_positions = {}
 cst = None
 x_security_token = None
 
+# Estados de consolidación (última señal de 15m) y hora de la última señal aceptada por símbolo
+consolidation_states = {}
+last_signal_times = {}
+
+# Cursor del historial de actividad del bróker y cierres detectados aún sin confirmar
+activity_cursor = {}
+pending_closures = {}
+# Cierres leídos del historial cuya posición todavía figuraba abierta (dealId -> cierre)
+unmatched_closures = {}
+
+# Posiciones tal como se publicaron por última vez en el estado compartido (símbolo -> JSON)
+published_positions = {}
+# Último valor leído o escrito por clave del estado compartido (JSON), para no reescribir valores sin cambios
+persisted_values = {}
+
+# Estado compartido entre workers de uvicorn (SQLite local) e identificador de este proceso
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+MONITOR_LEASE_TTL = 120
+SYMBOL_LOCK_TTL = 60
+SYMBOL_LOCK_TIMEOUT = 30
+SYNC_LOCK_TTL = 60
+SYNC_LOCK_TIMEOUT = 30
+# Las tareas que leen o modifican el estado en memoria de este proceso corren en hilos, de a una
+local_state_lock = threading.RLock()
+
+# Estado persistido en la base SQLite local (modo WAL, escritura sincronizada) para arranques en caliente
+PERSISTED_STATE_KEYS = ["open_positions", "consolidation_states", "last_signal_times", "activity_cursor", "pending_closures", "unmatched_closures"]
+
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 GOOGLE_CREDENTIALS = os.getenv("GOOGLE_CREDENTIALS")
 
@@ -43,39 +78,465 @@ except json.JSONDecodeError as e:
 FOLDER_ID = "1bKPwlyVt8a-EizPOTJYDioFNvaWqKja3"
 FILE_NAME = "last_signal_15m.json"
 POSITIONS_FILE_NAME = "open_positions.json"
+ACTIVITY_CURSOR_FILE_NAME = "activity_cursor.json"
+JOURNAL_FILE_NAME = "trade_journal.bin"
+QUOTES_DIR = "quotes"
 
 creds = service_account.Credentials.from_service_account_info(SERVICE_ACCOUNT_INFO, scopes=SCOPES)
 service = build("drive", "v3", credentials=creds)
 
+# Apalancamiento usado para calibrar las cantidades de cada instrumento
+LEVERAGE = 100.0
+
+class Instrument:
+    __slots__ = (
+        "symbol", "base_currency", "quote_currency", "decimals", "tick_size", "quantity",
+        "distance_per_usd", "stop_distance", "stop_distance_no_cons", "take_profit_distance_no_cons", "operated"
+    )
+
+    def __init__(self, symbol, decimals, quantity, stop_loss_usd, stop_loss_usd_no_cons, take_profit_usd_no_cons, operated):
+        self.symbol = symbol
+        self.base_currency = symbol[:3]
+        self.quote_currency = symbol[3:]
+        self.decimals = decimals
+        self.tick_size = 10 ** -decimals
+        # Cantidad ajustada para que las distancias fijas (sin spread) den la pérdida/ganancia en USD buscada
+        self.quantity = quantity
+        # Distancia de precio equivalente a 1 USD con el apalancamiento configurado
+        self.distance_per_usd = LEVERAGE / quantity
+        # Distancias fijas de stop loss y take profit derivadas de los objetivos en USD
+        self.stop_distance = stop_loss_usd * self.distance_per_usd
+        self.stop_distance_no_cons = stop_loss_usd_no_cons * self.distance_per_usd
+        self.take_profit_distance_no_cons = take_profit_usd_no_cons * self.distance_per_usd
+        self.operated = operated
+
+# Tabla de instrumentos:
+# símbolo, decimales, quantity ajustada,
+# stop loss en USD (source="volatility"), stop loss en USD (source="no cons"),
+# take profit en USD (source="no cons", sin spread), si se opera
+INSTRUMENT_TABLE = [
+    ("USDMXN", 5, 49801.0, 10.0, 5.0, 3.0, True),
+    ("USDCAD", 5, 699300.7, 10.0, 3.0, 3.0, True),
+    ("EURUSD", 5, 1000000.0, 10.0, 3.0, 3.0, True),
+    ("USDJPY", 3, 6666.67, 10.0, 3.0, 3.0, False)
+]
+
+INSTRUMENTS = {row[0]: Instrument(*row) for row in INSTRUMENT_TABLE}
+
 # Símbolos que operas
-SYMBOLS_OPERATED = ["USDCAD", "EURUSD", "USDMXN"]
-
-# Diccionario de distancias de stop loss fijas para 10 dólares de pérdida (source="volatility")
-STOP_LOSS_DISTANCES = {
-    "USDMXN": 0.02007,
-    "USDCAD": 0.00143,
-    "EURUSD": 0.00100,
-    "USDJPY": 0.150
+SYMBOLS_OPERATED = [symbol for symbol, instrument in INSTRUMENTS.items() if instrument.operated]
+
+# Reglas de gestión de posiciones por source (umbrales en USD, None desactiva la regla):
+# break_even_usd: mover el stop loss al precio de entrada al alcanzar esa ganancia
+# trailing_start_usd / trailing_distance_usd: activar trailing stop y distancia al extremo alcanzado
+# close_at_take_profit: cerrar desde el monitor cuando el precio alcanza el take profit
+POSITION_RULES = {
+    "volatility": {"break_even_usd": 10.0, "trailing_start_usd": 13.0, "trailing_distance_usd": 3.0, "close_at_take_profit": False},
+    "no cons": {"break_even_usd": None, "trailing_start_usd": None, "trailing_distance_usd": None, "close_at_take_profit": True}
 }
+POSITION_RULE_THRESHOLDS = ("break_even_usd", "trailing_start_usd", "trailing_distance_usd")
+
+# Tablas de reglas indexadas por source; la última fila corresponde a sources sin reglas
+RULE_INDEX = {source: i for i, source in enumerate(POSITION_RULES)}
+RULE_THRESHOLDS = np.array(
+    [[np.nan if rules[field] is None else rules[field] for field in POSITION_RULE_THRESHOLDS] for rules in POSITION_RULES.values()]
+    + [[np.nan] * len(POSITION_RULE_THRESHOLDS)]
+)
+RULE_CLOSE_AT_TAKE_PROFIT = np.array([rules["close_at_take_profit"] for rules in POSITION_RULES.values()] + [False])
 
-# Diccionario de distancias de stop loss fijas para 3 dólares de pérdida (source="no cons")
-# Ajustado a 5 USD para USDMXN
-STOP_LOSS_DISTANCES_NO_CONS = {
-    "USDMXN": 0.01004,  # 5 USD: (5 * 100) / 49801.0
-    "USDCAD": 0.000429,
-    "EURUSD": 0.00030,
-    "USDJPY": 0.045
+# Máximo de epics por consulta a /markets
+MARKETS_BATCH_SIZE = 50
+
+# Fila por posición para la evaluación vectorizada de reglas
+POSITION_DTYPE = np.dtype([
+    ("sign", "f8"),
+    ("entry_price", "f8"),
+    ("stop_loss", "f8"),
+    ("take_profit", "f8"),
+    ("upl", "f8"),
+    ("highest_price", "f8"),
+    ("lowest_price", "f8"),
+    ("trailing_active", "?"),
+    ("rule", "i8"),
+    ("distance_per_usd", "f8"),
+    ("scale", "f8"),
+    ("bid", "f8"),
+    ("offer", "f8"),
+    ("min_stop_distance", "f8")
+])
+
+# Límites del filtro de riesgo previo a la operación (MAX_EXPOSURE_USD=0 desactiva el límite de exposición)
+MAX_OPEN_POSITIONS = int(os.getenv("MAX_OPEN_POSITIONS", str(len(SYMBOLS_OPERATED))))
+SIGNAL_COOLDOWN_SECONDS = float(os.getenv("SIGNAL_COOLDOWN_SECONDS", "60"))
+MAX_EXPOSURE_USD = float(os.getenv("MAX_EXPOSURE_USD", "0"))
+
+# Tiempos de espera por endpoint del bróker (segundos)
+BROKER_TIMEOUTS = {
+    "session": 10,
+    "markets": 5,
+    "positions": 10,
+    "confirms": 5,
+    "history": 10
 }
+BROKER_DEFAULT_TIMEOUT = 10
+# Reintentos con backoff exponencial y jitter, solo para peticiones GET (idempotentes)
+BROKER_MAX_RETRIES = 2
+BROKER_BACKOFF_BASE = 0.5
+BROKER_BACKOFF_MAX = 4.0
+# Presupuesto de reintentos: cada petición aporta 0.2 reintentos, acumulables hasta 10
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 10.0
+# Circuit breaker: fallos consecutivos para abrir, segundos abierto y sondas en half-open
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+CIRCUIT_HALF_OPEN_PROBES = 1
+
+# Ventana inicial del historial de actividad cuando no hay cursor guardado
+ACTIVITY_LOOKBACK_SECONDS = 3600
+# Lecturas fallidas seguidas del historial tras las que el cursor vuelve a la ventana inicial
+ACTIVITY_MAX_FAILED_READS = 3
+# Tiempo máximo de espera por el evento de cierre antes de reportar motivo desconocido,
+# y tiempo que se conserva un evento de cierre a la espera de que su posición desaparezca
+PENDING_CLOSURE_TIMEOUT = 300
 
-# Diccionario para distancias de take profit (para 3 dólares de ganancia, source="no cons")
-# Distancias proporcionadas para generar exactamente 3 USD de ganancia (sin spread)
-TAKE_PROFIT_DISTANCES_NO_CONS = {
-    "USDMXN": 0.00605,  # Proporcionado para 3 USD de ganancia
-    "USDCAD": 0.00043,  # Proporcionado para 3 USD de ganancia
-    "EURUSD": 0.00030,  # Proporcionado para 3 USD de ganancia
-    "USDJPY": 0.045     # Actualizado a 0.045 para 3 USD de ganancia
+# Motivos de cierre según el campo "source" del historial de actividad
+CLOSE_REASONS = {
+    "SL": "stop loss",
+    "TP": "take profit",
+    "USER": "cierre manual",
+    "DEALER": "el bróker",
+    "CLOSE_OUT": "cierre por margen",
+    "SYSTEM": "el sistema"
 }
 
+# Registro fijo del diario de operaciones (append-only, un registro por evento open/amend/close)
+JOURNAL_DTYPE = np.dtype([
+    ("timestamp", "f8"),
+    ("event", "S5"),
+    ("symbol", "S12"),
+    ("source", "S16"),
+    ("direction", "S4"),
+    ("deal_id", "S40"),
+    ("entry_price", "f8"),
+    ("price", "f8"),
+    ("stop_loss", "f8"),
+    ("take_profit", "f8"),
+    ("spread_at_open", "f8"),
+    ("pnl_usd", "f8")
+])
+
+# Buffer circular de cotizaciones por epic (número de registros por archivo)
+QUOTE_RING_CAPACITY = 100000
+QUOTE_DTYPE = np.dtype([
+    ("timestamp", "f8"),
+    ("bid", "f8"),
+    ("offer", "f8"),
+    ("spread", "f8")
+])
+
+class QuoteRingBuffer:
+    # Cabecera: [número total de escrituras, capacidad], seguida de los registros
+    HEADER_SIZE = 16
+
+    def __init__(self, path, capacity=QUOTE_RING_CAPACITY):
+        size = self.HEADER_SIZE + capacity * QUOTE_DTYPE.itemsize
+        # Todos los workers escriben en el mismo archivo: cada operación toma un flock sobre él
+        self.file = open(path, "a+b")
+        with self.locked(fcntl.LOCK_EX):
+            if os.path.getsize(path) != size:
+                self.file.truncate(0)
+                self.file.truncate(size)
+            self.capacity = capacity
+            self.header = np.memmap(path, dtype="i8", mode="r+", shape=(2,))
+            self.header[1] = capacity
+            self.data = np.memmap(path, dtype=QUOTE_DTYPE, mode="r+", offset=self.HEADER_SIZE, shape=(capacity,))
+
+    @contextmanager
+    def locked(self, operation):
+        fcntl.flock(self.file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def append(self, timestamp, bid, offer):
+        with self.locked(fcntl.LOCK_EX):
+            count = int(self.header[0])
+            # Escritura directa sobre el archivo mapeado; los datos más viejos se sobrescriben
+            self.data[count % self.capacity] = (timestamp, bid, offer, offer - bid)
+            self.header[0] = count + 1
+
+    def window(self, n=None, since=None):
+        with self.locked(fcntl.LOCK_SH):
+            count = int(self.header[0])
+            available = min(count, self.capacity)
+            n = available if n is None else min(n, available)
+            quotes = self.data[np.arange(count - n, count) % self.capacity]
+        if since is not None:
+            quotes = quotes[quotes["timestamp"] >= since]
+        return quotes
+
+quote_recorders = {}
+
+# Caché de tipos de cambio alimentada por las cotizaciones ya obtenidas: par -> (precio medio, timestamp)
+FX_MAX_AGE_SECONDS = 300
+fx_rates = {}
+
+class PortfolioAggregator:
+    # Exposición y UPL en USD por símbolo, con totales actualizados de forma incremental en cada cotización
+    def __init__(self):
+        self.positions = {}
+        self.total_exposure_usd = 0.0
+        self.total_upl_usd = 0.0
+        # Símbolos cuya exposición no se pudo valorar en USD (cuentan como 0 en los totales)
+        self.unpriced = set()
+
+    def reset(self, positions):
+        self.positions = {}
+        self.total_exposure_usd = 0.0
+        self.total_upl_usd = 0.0
+        self.unpriced = set()
+        for symbol, pos in positions.items():
+            rate = fx_rates.get(symbol)
+            if rate is not None and time.time() - rate[1] <= FX_MAX_AGE_SECONDS:
+                self.revalue(symbol, pos, rate[0], rate[0])
+            if symbol not in self.positions:
+                # Sin cotización reciente: usar el upl reportado por el bróker
+                exposure_usd = self._exposure_usd(symbol, pos, pos["entry_price"])
+                self._set(symbol, exposure_usd if exposure_usd is not None else 0.0, pos.get("upl", 0.0))
+                if exposure_usd is None:
+                    self.unpriced.add(symbol)
+
+    def revalue(self, symbol, pos, current_bid, current_offer):
+        size = pos.get("size")
+        if size is None:
+            return
+        mark = current_bid if pos["direction"] == "BUY" else current_offer
+        sign = 1.0 if pos["direction"] == "BUY" else -1.0
+        base_currency, quote_currency = split_currencies(symbol)
+        quote_rate = get_usd_rate(quote_currency)
+        exposure_usd = self._exposure_usd(symbol, pos, mark)
+        if quote_rate is None or exposure_usd is None:
+            logger.warning(f"Sin tipo de cambio reciente para valorar {symbol} en USD")
+            return
+        self._set(symbol, exposure_usd, sign * (mark - pos["entry_price"]) * size * quote_rate)
+
+    def remove(self, symbol):
+        self.unpriced.discard(symbol)
+        exposure_usd, upl_usd = self.positions.pop(symbol, (0.0, 0.0))
+        self.total_exposure_usd -= exposure_usd
+        self.total_upl_usd -= upl_usd
+
+    def upl_usd(self, symbol, default=0.0):
+        return self.positions[symbol][1] if symbol in self.positions else default
+
+    def _exposure_usd(self, symbol, pos, price):
+        base_currency, quote_currency = split_currencies(symbol)
+        base_rate = get_usd_rate(base_currency)
+        if base_rate is None and quote_currency == "USD":
+            base_rate = price
+        return None if base_rate is None else pos.get("size", 0.0) * base_rate
+
+    def _set(self, symbol, exposure_usd, upl_usd):
+        self.unpriced.discard(symbol)
+        old_exposure_usd, old_upl_usd = self.positions.get(symbol, (0.0, 0.0))
+        self.positions[symbol] = (exposure_usd, upl_usd)
+        self.total_exposure_usd += exposure_usd - old_exposure_usd
+        self.total_upl_usd += upl_usd - old_upl_usd
+
+portfolio = PortfolioAggregator()
+
+class LeaseLostError(RuntimeError):
+    pass
+
+class SharedState:
+    # Valores JSON y leases con expiración sobre SQLite, compartidos por todos los workers del host
+    def __init__(self, path):
+        self.path = path
+        # Leases tomados por cada hilo con lease(), para verificarlos antes de cada llamada al bróker
+        self.held = threading.local()
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        # Cada commit queda en disco: esta base es el único almacén local para el arranque en caliente
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def get_many(self, keys):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(f"SELECT key, value FROM kv WHERE key IN ({', '.join('?' * len(keys))})", keys).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, key, value):
+        with closing(self._connect()) as conn:
+            conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def merge(self, key, changed, removed=()):
+        # Actualiza solo las entradas indicadas de un diccionario compartido, en una transacción
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            value = json.loads(row[0]) if row else {}
+            value.update(changed)
+            for item in removed:
+                value.pop(item, None)
+            conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+            conn.execute("COMMIT")
+
+    def update(self, key, func):
+        # Lee, modifica y escribe un valor compartido en una sola transacción
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            value = func(json.loads(row[0]) if row else {})
+            conn.execute("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+            conn.execute("COMMIT")
+        return value
+
+    def try_acquire(self, name, owner, ttl):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            acquired = row is None or row[0] == owner or row[1] < now
+            if acquired:
+                conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)", (name, owner, now + ttl))
+            conn.execute("COMMIT")
+        return acquired
+
+    def release(self, name, owner):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    @contextmanager
+    def lease(self, name, ttl, timeout):
+        owner = f"{WORKER_ID}:{uuid.uuid4().hex}"
+        deadline = time.time() + timeout
+        while not self.try_acquire(name, owner, ttl):
+            if time.time() > deadline:
+                raise TimeoutError(f"No se pudo obtener el lock {name} en {timeout}s")
+            time.sleep(0.05)
+        # Renovar el lease mientras dure la operación; si otro worker lo tomó, se marca como perdido
+        lost = threading.Event()
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(ttl / 3):
+                try:
+                    renewed = self.try_acquire(name, owner, ttl)
+                except sqlite3.Error as e:
+                    logger.warning(f"No se pudo renovar el lock {name}: {e}")
+                    continue
+                if not renewed:
+                    logger.error(f"Lock {name} perdido: otro worker lo tomó tras expirar")
+                    lost.set()
+                    return
+        heartbeat = threading.Thread(target=renew, name=f"lease-{name}", daemon=True)
+        heartbeat.start()
+        held = self.held.__dict__.setdefault("leases", [])
+        held.append((name, lost))
+        try:
+            yield
+        finally:
+            held.remove((name, lost))
+            stop.set()
+            heartbeat.join()
+            self.release(name, owner)
+
+    def check_leases(self):
+        # Falla la operación en curso si alguno de los leases de este hilo se perdió
+        for name, lost in self.held.__dict__.get("leases", []):
+            if lost.is_set():
+                raise LeaseLostError(f"Lock {name} perdido, operación cancelada")
+
+shared_state = SharedState(STATE_DB_PATH)
+
+class BrokerError(Exception):
+    # Error del bróker con código tipado, p. ej. "error.invalid.stoploss.maxvalue" y su valor 1.23456
+    def __init__(self, code, message, status_code=None, endpoint=None):
+        super().__init__(message)
+        code, _, value = code.partition(": ")
+        self.code = code
+        self.value = None
+        if value:
+            try:
+                self.value = float(value)
+            except ValueError:
+                self.value = value
+        self.status_code = status_code
+        self.endpoint = endpoint
+
+    @property
+    def transient(self):
+        # Fallos de red, del servidor o por límite de peticiones, que no dependen de la petición
+        return self.code in ("error.timeout", "error.connection", "error.circuit.open", "error.too-many.requests") or (self.status_code is not None and (self.status_code >= 500 or self.status_code == 429))
+
+class CircuitOpenError(BrokerError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout, half_open_probes):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+
+    def before_request(self):
+        if self.state == "open":
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("error.circuit.open", f"API de Capital.com no disponible, reintento en {self.retry_after():.0f}s")
+            self.state = "half_open"
+            self.probes_in_flight = 0
+            logger.info("Circuit breaker en half-open: enviando petición de prueba")
+        if self.state == "half_open":
+            if self.probes_in_flight >= self.half_open_probes:
+                raise CircuitOpenError("error.circuit.open", "API de Capital.com en prueba de recuperación")
+            self.probes_in_flight += 1
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("Circuit breaker cerrado: API de Capital.com recuperada")
+            send_telegram_message("✅ API de Capital.com recuperada, operaciones reanudadas")
+        self.state = "closed"
+        self.failures = 0
+        self.probes_in_flight = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            if self.state == "closed":
+                send_telegram_message(f"⚠️ API de Capital.com degradada tras {self.failures} fallos seguidos, pausando peticiones {self.reset_timeout}s")
+            logger.warning(f"Circuit breaker abierto tras {self.failures} fallos")
+            self.state = "open"
+            self.opened_at = time.time()
+
+    def retry_after(self):
+        return max(0.0, self.reset_timeout - (time.time() - self.opened_at)) if self.state == "open" else 0.0
+
+class RetryBudget:
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+broker_circuit = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_HALF_OPEN_PROBES)
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MAX)
+
 # Definición de funciones auxiliares
 def send_telegram_message(message):
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
@@ -127,37 +588,284 @@ def load_signal():
 def save_positions(data):
     with open(POSITIONS_FILE_NAME, "w") as f:
         json.dump(data, f)
+    publish_positions(data)
+    upload_file(POSITIONS_FILE_NAME, POSITIONS_FILE_NAME)
+
+def save_position_states(states):
+    # Campos de varias posiciones en una sola escritura, solo si la posición compartida sigue con el mismo dealId
+    def apply_states(positions):
+        for symbol, state in states.items():
+            pos = positions.get(symbol)
+            if pos is not None and pos["dealId"] == state["dealId"]:
+                pos.update(state)
+        return positions
+    positions = shared_state.update("open_positions", apply_states)
+    with open(POSITIONS_FILE_NAME, "w") as f:
+        json.dump(positions, f)
     upload_file(POSITIONS_FILE_NAME, POSITIONS_FILE_NAME)
 
+def publish_positions(data):
+    global published_positions
+    # Publicar solo los símbolos que cambiaron para no pisar cambios de otros workers
+    encoded = {symbol: json.dumps(pos, sort_keys=True) for symbol, pos in data.items()}
+    changed = {symbol: data[symbol] for symbol, value in encoded.items() if published_positions.get(symbol) != value}
+    removed = [symbol for symbol in published_positions if symbol not in encoded]
+    if changed or removed:
+        persist_state("open_positions", changed, removed)
+    published_positions = encoded
+
+def persist_state(key, changed, removed=()):
+    if changed or removed:
+        shared_state.merge(key, changed, removed)
+
+def replace_state(key, value):
+    encoded = json.dumps(value, sort_keys=True)
+    if persisted_values.get(key) == encoded:
+        return
+    shared_state.set(key, value)
+    persisted_values[key] = encoded
+
+def restore_state():
+    # Estado de la base local (de otro worker o de la ejecución anterior); False si hay que arrancar en frío desde Drive
+    state = load_shared_state()
+    return "open_positions" in state
+
+def load_shared_state():
+    global open_positions, consolidation_states, last_signal_times, activity_cursor, pending_closures, unmatched_closures, published_positions
+    state = shared_state.get_many(PERSISTED_STATE_KEYS + ["fx_rates"])
+    # Tipos de cambio obtenidos por otros workers, si son más recientes que los propios
+    for pair, (rate, timestamp) in state.get("fx_rates", {}).items():
+        if pair not in fx_rates or fx_rates[pair][1] < timestamp:
+            fx_rates[pair] = (rate, timestamp)
+    if "open_positions" in state:
+        open_positions = state["open_positions"]
+        published_positions = {symbol: json.dumps(pos, sort_keys=True) for symbol, pos in open_positions.items()}
+        # Las posiciones abiertas o cerradas por otros workers cuentan para la exposición de este
+        portfolio.reset(open_positions)
+    consolidation_states = state.get("consolidation_states", consolidation_states)
+    last_signal_times = state.get("last_signal_times", last_signal_times)
+    activity_cursor = state.get("activity_cursor", activity_cursor)
+    pending_closures = state.get("pending_closures", pending_closures)
+    unmatched_closures = state.get("unmatched_closures", unmatched_closures)
+    for key in PERSISTED_STATE_KEYS:
+        if key in state:
+            persisted_values[key] = json.dumps(state[key], sort_keys=True)
+    return state
+
 def load_positions():
     positions = download_file(POSITIONS_FILE_NAME)
     return positions if positions is not None else {}
 
+def save_activity_cursor(data):
+    with open(ACTIVITY_CURSOR_FILE_NAME, "w") as f:
+        json.dump(data, f)
+    replace_state("activity_cursor", data)
+    upload_file(ACTIVITY_CURSOR_FILE_NAME, ACTIVITY_CURSOR_FILE_NAME)
+
+def load_activity_cursor():
+    cursor = download_file(ACTIVITY_CURSOR_FILE_NAME)
+    return cursor if cursor else {}
+
+def utc_timestamp(offset_seconds=0):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() + offset_seconds))
+
+def journal_event(event, symbol, pos, price=None, pnl_usd=None):
+    # El diario nunca debe interrumpir una operación ya enviada al bróker: cualquier error solo se registra
+    try:
+        record = np.zeros(1, dtype=JOURNAL_DTYPE)
+        record["timestamp"] = time.time()
+        # Los campos de texto se guardan en UTF-8 (p. ej. source="señal"), truncados al ancho del campo
+        for field, value in (("event", event), ("symbol", symbol), ("source", pos.get("source")),
+                             ("direction", pos.get("direction")), ("deal_id", pos.get("dealId"))):
+            record[field] = str(value or "").encode("utf-8", errors="replace")
+        for field, value in (("entry_price", pos.get("entry_price")), ("price", price), ("stop_loss", pos.get("stop_loss")),
+                             ("take_profit", pos.get("take_profit")), ("spread_at_open", pos.get("spread_at_open")), ("pnl_usd", pnl_usd)):
+            record[field] = np.nan if value is None else value
+        with open(JOURNAL_FILE_NAME, "ab") as f:
+            f.write(record.tobytes())
+    except Exception as e:
+        logger.error(f"Error al escribir en el diario de operaciones: {e}")
+
+def load_journal():
+    if not os.path.exists(JOURNAL_FILE_NAME):
+        return np.zeros(0, dtype=JOURNAL_DTYPE)
+    # Ignorar un posible registro incompleto al final del archivo
+    count = os.path.getsize(JOURNAL_FILE_NAME) // JOURNAL_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=JOURNAL_DTYPE)
+    return np.memmap(JOURNAL_FILE_NAME, dtype=JOURNAL_DTYPE, mode="r", shape=(count,))
+
+def summarize_trades(keys, pnl):
+    if len(pnl) == 0:
+        return {}
+    groups, inverse = np.unique(keys, return_inverse=True)
+    trades = np.bincount(inverse, minlength=len(groups))
+    wins = np.bincount(inverse, weights=(pnl > 0), minlength=len(groups))
+    total = np.bincount(inverse, weights=pnl, minlength=len(groups))
+    # Curva de capital por grupo en orden cronológico (el orden estable conserva el orden del diario)
+    order = np.argsort(inverse, kind="stable")
+    sorted_groups = inverse[order]
+    equity = np.cumsum(pnl[order])
+    starts = np.searchsorted(sorted_groups, np.arange(len(groups)))
+    group_equity = equity - np.concatenate(([0.0], equity))[starts][sorted_groups]
+    # Máximo acumulado por grupo: desplazar cada grupo para que no se mezclen en un solo accumulate
+    shift = (group_equity.max() - group_equity.min() + 1.0) * sorted_groups
+    peak = np.maximum(np.maximum.accumulate(group_equity + shift) - shift, 0.0)
+    max_drawdown = np.maximum.reduceat(peak - group_equity, starts)
+    return {
+        group.decode("utf-8", errors="replace"): {
+            "trades": int(trades[i]),
+            "win_rate": round(float(wins[i] / trades[i]), 4),
+            "expectancy_usd": round(float(total[i] / trades[i]), 2),
+            "total_pnl_usd": round(float(total[i]), 2),
+            "max_drawdown_usd": round(float(max_drawdown[i]), 2)
+        }
+        for i, group in enumerate(groups)
+    }
+
+def get_quote_recorder(epic):
+    recorder = quote_recorders.get(epic)
+    if recorder is None:
+        os.makedirs(QUOTES_DIR, exist_ok=True)
+        recorder = QuoteRingBuffer(os.path.join(QUOTES_DIR, f"{epic}.ring"))
+        quote_recorders[epic] = recorder
+    return recorder
+
+def record_quote(epic, bid, offer):
+    try:
+        get_quote_recorder(epic).append(time.time(), bid, offer)
+    except OSError as e:
+        logger.error(f"Error al registrar cotización de {epic}: {e}")
+
+def split_currencies(symbol):
+    instrument = INSTRUMENTS.get(symbol)
+    if instrument is not None:
+        return instrument.base_currency, instrument.quote_currency
+    return symbol[:3], symbol[3:]
+
+def price_decimals(symbol):
+    instrument = INSTRUMENTS.get(symbol)
+    return instrument.decimals if instrument is not None else 5
+
+def get_usd_rate(currency, max_age=FX_MAX_AGE_SECONDS):
+    # Factor para convertir un importe en `currency` a USD, o None si no hay cotización reciente
+    if currency == "USD":
+        return 1.0
+    now = time.time()
+    direct = fx_rates.get(f"{currency}USD")
+    if direct is not None and now - direct[1] <= max_age:
+        return direct[0]
+    inverse = fx_rates.get(f"USD{currency}")
+    if inverse is not None and now - inverse[1] <= max_age:
+        return 1.0 / inverse[0]
+    return None
+
+def handle_quote(epic, bid, offer):
+    record_quote(epic, bid, offer)
+    if len(epic) == 6 and epic.isalpha():
+        fx_rates[epic] = ((bid + offer) / 2, time.time())
+    if epic in open_positions:
+        portfolio.revalue(epic, open_positions[epic], bid, offer)
+
+def share_fx_rates(pairs):
+    # Publicar los tipos de cambio recién cotizados para que los demás workers valoren su exposición
+    changed = {pair: fx_rates[pair] for pair in pairs if pair in fx_rates}
+    if changed:
+        shared_state.merge("fx_rates", changed)
+
+def get_quote_window(epic, n=None, since=None):
+    # Devuelve las últimas n cotizaciones (de la más antigua a la más reciente) como array estructurado
+    return get_quote_recorder(epic).window(n=n, since=since)
+
+def broker_error_from_response(response, description, endpoint):
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    error_code = body.get("errorCode") if isinstance(body, dict) else None
+    return BrokerError(error_code or f"error.http.{response.status_code}", f"{description}: {response.text or 'Respuesta vacía'}", status_code=response.status_code, endpoint=endpoint)
+
+def broker_request(method, path, headers, description, params=None, payload=None):
+    endpoint = path.strip("/").split("/")[0]
+    timeout = BROKER_TIMEOUTS.get(endpoint, BROKER_DEFAULT_TIMEOUT)
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        shared_state.check_leases()
+        broker_circuit.before_request()
+        retry_after = 0.0
+        try:
+            response = requests.request(method, f"{CAPITAL_API_URL}{path}", headers=headers, params=params, json=payload, timeout=timeout)
+        except requests.Timeout:
+            error = BrokerError("error.timeout", f"{description}: sin respuesta en {timeout}s", endpoint=endpoint)
+        except requests.RequestException as e:
+            error = BrokerError("error.connection", f"{description}: {e}", endpoint=endpoint)
+        else:
+            if response.status_code < 500 and response.status_code != 429:
+                # Un 4xx indica que el servidor responde: no cuenta como fallo para el circuito
+                broker_circuit.record_success()
+                if response.status_code == 200:
+                    return response
+                raise broker_error_from_response(response, description, endpoint)
+            error = broker_error_from_response(response, description, endpoint)
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.headers.get("Retry-After", 0))
+                except ValueError:
+                    retry_after = 0.0
+        broker_circuit.record_failure()
+        # Un 429 se rechaza sin procesar la petición, así que se puede reintentar aunque no sea un GET,
+        # siempre que la espera pedida por el servidor quepa en el backoff máximo
+        retryable = method == "GET" or error.status_code == 429
+        if not retryable or retry_after > BROKER_BACKOFF_MAX or attempt >= BROKER_MAX_RETRIES or broker_circuit.state == "open" or not retry_budget.withdraw():
+            raise error
+        delay = max(retry_after, random.uniform(0, min(BROKER_BACKOFF_MAX, BROKER_BACKOFF_BASE * 2 ** attempt)))
+        logger.warning(f"{error} [{error.code}], reintento {attempt + 1}/{BROKER_MAX_RETRIES} en {delay:.2f}s")
+        time.sleep(delay)
+        attempt += 1
+
 def authenticate():
     headers = {"X-CAP-API-KEY": API_KEY, "Content-Type": "application/json"}
     payload = {"identifier": ACCOUNT_ID, "password": CUSTOM_PASSWORD}
-    response = requests.post(f"{CAPITAL_API_URL}/session", headers=headers, json=payload)
-    if response.status_code != 200:
-        raise Exception(f"Error de autenticación: {response.text}")
+    response = broker_request("POST", "/session", headers, "Error de autenticación", payload=payload)
     cst = response.headers.get("CST")
     x_security_token = response.headers.get("X-SECURITY-TOKEN")
+    shared_state.set("session", {"cst": cst, "x_security_token": x_security_token})
     return cst, x_security_token
 
 def get_market_details(cst: str, x_security_token: str, epic: str):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
-    response = requests.get(f"{CAPITAL_API_URL}/markets/{epic}", headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error al obtener detalles del mercado: {response.text}")
-    details = response.json()
+    response = broker_request("GET", f"/markets/{epic}", headers, "Error al obtener detalles del mercado")
+    details = parse_market_details(epic, response.json())
+    share_fx_rates([epic])
+    return details
+
+def get_market_snapshots(cst: str, x_security_token: str, epics):
+    # Detalles de varios mercados en una sola consulta por lote
+    headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
+    quotes = {}
+    for start in range(0, len(epics), MARKETS_BATCH_SIZE):
+        batch = epics[start:start + MARKETS_BATCH_SIZE]
+        response = broker_request("GET", "/markets", headers, "Error al obtener detalles de mercados", params={"epics": ",".join(batch)})
+        for details in response.json().get("marketDetails", []):
+            epic = details["instrument"]["epic"]
+            quotes[epic] = parse_market_details(epic, details)
+    share_fx_rates(quotes)
+    return quotes
+
+def parse_market_details(epic, details):
     min_size = details["dealingRules"]["minDealSize"]["value"]
     current_bid = details["snapshot"]["bid"]
     current_offer = details["snapshot"]["offer"]
     spread = current_offer - current_bid
+    handle_quote(epic, current_bid, current_offer)
     # Ajustar min_stop_distance y min_limit_distance según el par de divisas
     min_stop_distance_raw = details["dealingRules"]["minStopOrProfitDistance"]["value"] if "minStopOrProfitDistance" in details["dealingRules"] else 10.0
     min_stop_distance_unit = details["dealingRules"]["minStopOrProfitDistance"]["unit"] if "minStopOrProfitDistance" in details["dealingRules"] else "POINTS"
+    instrument = INSTRUMENTS.get(epic)
     if min_stop_distance_unit == "POINTS":
-        min_stop_distance = min_stop_distance_raw * 0.00001  # Convertir puntos a precio (5 decimales)
+        # Convertir puntos a precio según los decimales del instrumento (5 por defecto)
+        min_stop_distance = min_stop_distance_raw * (instrument.tick_size if instrument is not None else 0.00001)
         min_limit_distance = min_stop_distance  # Usamos el mismo valor para take profit
     else:  # PERCENTAGE
         min_stop_distance = current_bid * (min_stop_distance_raw / 100)
@@ -170,9 +878,7 @@ def get_market_details(cst: str, x_security_token: str, epic: str):
 
 def get_position_details(cst: str, x_security_token: str, epic: str):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
-    response = requests.get(f"{CAPITAL_API_URL}/positions", headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error al obtener posiciones: {response.text}")
+    response = broker_request("GET", "/positions", headers, "Error al obtener posiciones")
     positions = response.json().get("positions", [])
     for position in positions:
         if position["market"]["epic"] == epic:
@@ -189,8 +895,14 @@ def get_position_details(cst: str, x_security_token: str, epic: str):
 def get_deal_confirmation(cst: str, x_security_token: str, deal_reference: str, retries=3, delay=1):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
     for attempt in range(retries):
-        response = requests.get(f"{CAPITAL_API_URL}/confirms/{deal_reference}", headers=headers)
-        if response.status_code == 200:
+        try:
+            response = broker_request("GET", f"/confirms/{deal_reference}", headers, "Error al obtener confirmación")
+        except CircuitOpenError:
+            raise
+        except BrokerError as e:
+            response = None
+            logger.error(f"Error al obtener confirmación (intento {attempt + 1}/{retries}): {e}")
+        if response is not None:
             confirmation = response.json()
             if "profit" in confirmation and confirmation["profit"] is not None:
                 profit = float(confirmation["profit"])
@@ -201,28 +913,119 @@ def get_deal_confirmation(cst: str, x_security_token: str, deal_reference: str,
                 return {"level": float(confirmation["level"]), "currency": confirmation.get("currency", "USD")}
             else:
                 logger.warning(f"Advertencia: Campos 'profit' o 'level' no encontrados en la confirmación (intento {attempt + 1}/{retries})")
-        else:
-            logger.error(f"Error al obtener confirmación (intento {attempt + 1}/{retries}): {response.text}")
         if attempt < retries - 1:
             time.sleep(delay)
-    raise Exception(f"No se pudo obtener la confirmación después de {retries} intentos")
+    raise BrokerError("error.confirmation.unavailable", f"No se pudo obtener la confirmación después de {retries} intentos")
+
+def fetch_closed_trades(cst: str, x_security_token: str):
+    global activity_cursor
+    headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
+    since = activity_cursor.get("last_date_utc") or utc_timestamp(-ACTIVITY_LOOKBACK_SECONDS)
+    params = {"from": since[:19], "detailed": "true"}
+    try:
+        response = broker_request("GET", "/history/activity", headers, "Error al obtener historial de actividad", params=params)
+    except CircuitOpenError:
+        raise
+    except BrokerError as e:
+        failed_reads = activity_cursor.get("failed_reads", 0) + 1
+        if e.status_code == 400 or failed_reads >= ACTIVITY_MAX_FAILED_READS:
+            # Cursor rechazado (p. ej. muy antiguo tras una caída): volver a la ventana inicial
+            logger.warning(f"Historial de actividad no disponible desde {since} ({failed_reads} intentos), reiniciando el cursor")
+            activity_cursor = {"last_date_utc": utc_timestamp(-ACTIVITY_LOOKBACK_SECONDS), "seen_ids": []}
+        else:
+            activity_cursor = dict(activity_cursor, failed_reads=failed_reads)
+        save_activity_cursor(activity_cursor)
+        raise
+    # Solo se procesan eventos nuevos: los del segundo del cursor ya vistos se descartan
+    seen_ids = set(activity_cursor.get("seen_ids", []))
+    last_date_utc = since
+    new_ids = []
+    closures = {}
+    for activity in response.json().get("activities", []):
+        date_utc = activity.get("dateUTC", "")
+        event_id = f"{activity.get('dealId')}@{date_utc}"
+        if event_id in seen_ids:
+            continue
+        new_ids.append((date_utc, event_id))
+        last_date_utc = max(last_date_utc, date_utc)
+        if activity.get("status") != "ACCEPTED":
+            continue
+        details = activity.get("details", {})
+        for action in details.get("actions", []):
+            if action.get("actionType") != "POSITION_CLOSED":
+                continue
+            deal_id = action.get("affectedDealId") or activity.get("dealId")
+            closures[deal_id] = {
+                "epic": activity.get("epic"),
+                "level": float(details["level"]) if details.get("level") is not None else None,
+                "source": activity.get("source"),
+                "currency": details.get("currency", "USD"),
+                "date_utc": date_utc,
+                "references": [deal_id, activity.get("dealId"), details.get("dealReference")]
+            }
+    if closures:
+        # El P&L realizado viene en las transacciones de tipo TRADE del mismo periodo
+        params = {"from": since[:19], "type": "TRADE"}
+        try:
+            response = broker_request("GET", "/history/transactions", headers, "Error al obtener historial de transacciones", params=params)
+        except BrokerError as e:
+            response = None
+            logger.warning(f"No se pudo obtener el historial de transacciones: {e}")
+        if response is not None:
+            transactions = {t.get("reference"): t for t in response.json().get("transactions", [])}
+            for closure in closures.values():
+                for reference in closure["references"]:
+                    if reference in transactions:
+                        closure["profit"] = float(transactions[reference]["size"])
+                        closure["currency"] = transactions[reference].get("currency", closure["currency"])
+                        break
+    if new_ids or "failed_reads" in activity_cursor:
+        boundary_ids = [event_id for date_utc, event_id in new_ids if date_utc[:19] == last_date_utc[:19]]
+        if last_date_utc[:19] == since[:19]:
+            boundary_ids += list(seen_ids)
+        activity_cursor = {"last_date_utc": last_date_utc, "seen_ids": boundary_ids}
+        save_activity_cursor(activity_cursor)
+    logger.info(f"Historial de actividad: {len(new_ids)} eventos nuevos, {len(closures)} cierres")
+    return closures
+
+def report_closed_position(symbol, pos, closure):
+    if closure is None:
+        send_telegram_message(f"🔒 Posición cerrada para {symbol}: {pos['direction']} a {pos['entry_price']}. Motivo desconocido.")
+        logger.info(f"Posición cerrada para {symbol}, motivo desconocido")
+        journal_event("close", symbol, pos)
+        return
+    reason = CLOSE_REASONS.get(closure["source"], f"motivo {closure['source']}")
+    exit_price = closure["level"]
+    if "profit" in closure:
+        profit_loss = convert_profit_to_usd(closure["profit"], symbol, exit_price, closure["currency"])
+    elif exit_price is not None:
+        profit_loss = convert_profit_to_usd(calculate_profit_from_exit(pos, exit_price), symbol, exit_price, pos.get("currency", "USD"))
+    else:
+        profit_loss = None
+    send_telegram_message(f"🔒 Posición cerrada por {reason} para {symbol}: {pos['direction']} a {pos['entry_price']}, cierre a {exit_price}. Ganancia/pérdida: {format_profit_loss(profit_loss)}")
+    logger.info(f"Posición cerrada por {reason} para {symbol}, exit_price: {exit_price}, profit_loss: {profit_loss} USD")
+    journal_event("close", symbol, pos, price=exit_price, pnl_usd=profit_loss)
 
 def sync_open_positions(cst: str, x_security_token: str):
+    # Un solo worker sincroniza a la vez, partiendo del último estado compartido
+    with shared_state.lease("sync", SYNC_LOCK_TTL, SYNC_LOCK_TIMEOUT):
+        load_shared_state()
+        return sync_positions_with_broker(cst, x_security_token)
+
+def sync_positions_with_broker(cst: str, x_security_token: str):
     global open_positions
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
     try:
-        response = requests.get(f"{CAPITAL_API_URL}/positions", headers=headers)
-        if response.status_code != 200:
-            if "errorCode" in response.json() and "invalid.session.token" in response.json()["errorCode"]:
-                logger.warning("Token de sesión inválido detectado, intentando reautenticación...")
-                new_cst, new_x_security_token = authenticate()
-                headers = {"X-CAP-API-KEY": API_KEY, "CST": new_cst, "X-SECURITY-TOKEN": new_x_security_token}
-                response = requests.get(f"{CAPITAL_API_URL}/positions", headers=headers)
-                if response.status_code != 200:
-                    raise Exception(f"Error al sincronizar posiciones tras reautenticación: {response.text}")
-                cst, x_security_token = new_cst, new_x_security_token
-            else:
-                raise Exception(f"Error al sincronizar posiciones: {response.text}")
+        try:
+            response = broker_request("GET", "/positions", headers, "Error al sincronizar posiciones")
+        except BrokerError as e:
+            if "invalid.session.token" not in e.code:
+                raise
+            logger.warning("Token de sesión inválido detectado, intentando reautenticación...")
+            new_cst, new_x_security_token = authenticate()
+            headers = {"X-CAP-API-KEY": API_KEY, "CST": new_cst, "X-SECURITY-TOKEN": new_x_security_token}
+            response = broker_request("GET", "/positions", headers, "Error al sincronizar posiciones tras reautenticación")
+            cst, x_security_token = new_cst, new_x_security_token
         positions = response.json().get("positions", [])
         logger.info(f"Respuesta de la API para posiciones: {json.dumps(positions, indent=2)}")
         synced_positions = {}
@@ -237,16 +1040,10 @@ def sync_open_positions(cst: str, x_security_token: str):
                 logger.warning(f"Advertencia: No se encontró stopLevel o profitLevel para posición en {epic}, usando None")
             size = float(pos["position"]["size"])
             # Ajustar quantity para que la distancia fija (sin spread) dé 10 dólares (o 3 dólares para "no cons")
-            if epic == "USDCAD":
-                quantity = 699300.7
-            elif epic == "EURUSD":
-                quantity = 1000000.0
-            elif epic == "USDMXN":
-                quantity = 49801.0
-            elif epic == "USDJPY":
-                quantity = 6666.67
-            else:
-                quantity = size * 100000
+            instrument = INSTRUMENTS.get(epic)
+            quantity = instrument.quantity if instrument is not None else size * 100000
+            previous = open_positions.get(epic, {})
+            same_deal = previous.get("dealId") == pos["position"]["dealId"]
             synced_positions[epic] = {
                 "direction": pos["position"]["direction"],
                 "entry_price": float(pos["position"]["level"]),
@@ -254,11 +1051,13 @@ def sync_open_positions(cst: str, x_security_token: str):
                 "take_profit": take_profit,
                 "dealId": pos["position"]["dealId"],
                 "quantity": quantity,
+                "size": size,
                 "upl": float(pos["position"]["upl"]) if "upl" in pos["position"] else 0.0,
                 "source": open_positions.get(epic, {}).get("source", "volatility"),
                 "spread_at_open": open_positions.get(epic, {}).get("spread_at_open", 0.0),
-                "highest_price": float(pos["position"]["level"]),
-                "lowest_price": float(pos["position"]["level"]),
+                # Conservar los extremos del trailing si es la misma posición
+                "highest_price": previous["highest_price"] if same_deal and "highest_price" in previous else float(pos["position"]["level"]),
+                "lowest_price": previous["lowest_price"] if same_deal and "lowest_price" in previous else float(pos["position"]["level"]),
                 "trailing_active": open_positions.get(epic, {}).get("trailing_active", False),
                 "currency": pos["position"]["currency"]
             }
@@ -266,30 +1065,33 @@ def sync_open_positions(cst: str, x_security_token: str):
         
         closed_positions = {k: v for k, v in open_positions.items() if k not in synced_positions}
         for symbol, pos in closed_positions.items():
-            # Verificar si se cerró por stop loss
-            if pos["stop_loss"] is not None and (
-                (pos["direction"] == "BUY" and pos["stop_loss"] >= pos["entry_price"]) or 
-                (pos["direction"] == "SELL" and pos["stop_loss"] <= pos["entry_price"])
-            ):
-                profit_loss = calculate_profit_loss_from_stop_loss(pos)
-                profit_loss_message = f"+${profit_loss} USD" if profit_loss >= 0 else f"-${abs(profit_loss)} USD"
-                send_telegram_message(f"🔒 Posición cerrada por stop loss para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia/pérdida: {profit_loss_message}")
-                logger.info(f"Posición cerrada por stop loss para {symbol}, profit_loss: {profit_loss} USD")
-            # Verificar si se cerró por take profit
-            elif pos["take_profit"] is not None and (
-                (pos["direction"] == "BUY" and pos["entry_price"] <= pos["take_profit"]) or 
-                (pos["direction"] == "SELL" and pos["entry_price"] >= pos["take_profit"])
-            ):
-                profit_loss = 3.0  # 3 USD para todos los símbolos
-                profit_loss_message = f"+${profit_loss} USD"
-                send_telegram_message(f"🔒 Posición cerrada por take profit para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia: {profit_loss_message}")
-                logger.info(f"Posición cerrada por take profit para {symbol}, profit_loss: {profit_loss} USD")
-            else:
-                # Si no se cerró por stop loss ni take profit, podría ser un cierre manual u otro motivo
-                send_telegram_message(f"🔒 Posición cerrada para {symbol}: {pos['direction']} a {pos['entry_price']}. Motivo desconocido.")
-                logger.info(f"Posición cerrada para {symbol}, motivo desconocido")
+            pending_closures[pos["dealId"]] = {"symbol": symbol, "position": pos, "detected_at": time.time()}
+        
+        # Leer solo los eventos nuevos del historial para obtener precio de cierre y P&L reales
+        try:
+            closures = fetch_closed_trades(cst, x_security_token)
+        except BrokerError as e:
+            # Los cierres pendientes se resuelven en la próxima lectura o se reportan sin motivo al vencer el plazo
+            logger.warning(f"No se pudo leer el historial de actividad: {e}")
+            closures = {}
+        now = time.time()
+        # La posición pudo cerrarse entre la consulta de posiciones y la del historial: conservar el evento
+        for deal_id, closure in closures.items():
+            unmatched_closures[deal_id] = dict(closure, received_at=now)
+        for deal_id, pending in list(pending_closures.items()):
+            if deal_id in unmatched_closures:
+                report_closed_position(pending["symbol"], pending["position"], unmatched_closures.pop(deal_id))
+                del pending_closures[deal_id]
+            elif now - pending["detected_at"] > PENDING_CLOSURE_TIMEOUT:
+                report_closed_position(pending["symbol"], pending["position"], None)
+                del pending_closures[deal_id]
+        for deal_id in [deal_id for deal_id, closure in unmatched_closures.items() if now - closure["received_at"] > PENDING_CLOSURE_TIMEOUT]:
+            del unmatched_closures[deal_id]
+        replace_state("unmatched_closures", unmatched_closures)
+        replace_state("pending_closures", pending_closures)
         
         open_positions = synced_positions
+        portfolio.reset(open_positions)
         save_positions(open_positions)
         return cst, x_security_token
     except Exception as e:
@@ -297,19 +1099,20 @@ def sync_open_positions(cst: str, x_security_token: str):
         raise
 
 def calculate_valid_stop_loss(entry_price, direction, loss_amount_usd, quantity, leverage, min_stop_distance, max_stop_distance=None, symbol=None, spread=None, source=None, current_bid=None, current_offer=None):
-    entry_price = round(entry_price, 5)
-    if symbol not in STOP_LOSS_DISTANCES:
+    instrument = INSTRUMENTS.get(symbol)
+    if instrument is None:
         raise ValueError(f"Símbolo {symbol} no soportado")
+    entry_price = round(entry_price, instrument.decimals)
     
     # Seleccionar la distancia fija según el source
     if source == "no cons":
-        fixed_stop_distance = STOP_LOSS_DISTANCES_NO_CONS[symbol]
+        fixed_stop_distance = instrument.stop_distance_no_cons
     else:  # source="volatility"
-        fixed_stop_distance = STOP_LOSS_DISTANCES[symbol]
+        fixed_stop_distance = instrument.stop_distance
     
     # Ajustar la distancia restando el spread para que la pérdida neta sea exacta
     adjusted_stop_distance = fixed_stop_distance - spread
-    adjusted_stop_distance = max(adjusted_stop_distance, 0.00001)
+    adjusted_stop_distance = max(adjusted_stop_distance, instrument.tick_size)
     logger.info(f"Cálculo de stop loss para {symbol}: entry_price={entry_price}, fixed_stop_distance={fixed_stop_distance}, spread={spread}, adjusted_stop_distance={adjusted_stop_distance}, direction={direction}, source={source}")
     
     if direction == "BUY":
@@ -331,21 +1134,22 @@ def calculate_valid_stop_loss(entry_price, direction, loss_amount_usd, quantity,
             logger.warning(f"Stop loss ajustado para cumplir con min_stop_distance: {stop_loss}, nueva pérdida inicial: {new_loss_amount} USD")
             send_telegram_message(f"⚠️ Stop loss ajustado para {symbol} (SELL) a {stop_loss} para cumplir con las restricciones del bróker. Pérdida inicial: -${new_loss_amount} USD")
     
-    return round(stop_loss, 5)
+    return round(stop_loss, instrument.decimals)
 
 def calculate_take_profit(entry_price, direction, profit_amount_usd, quantity, leverage, min_limit_distance, symbol, source, current_bid, current_offer, spread):
     if source != "no cons":
         return None  # Solo aplicamos take profit para source="no cons"
     
-    if symbol not in TAKE_PROFIT_DISTANCES_NO_CONS:
+    instrument = INSTRUMENTS.get(symbol)
+    if instrument is None:
         raise ValueError(f"Símbolo {symbol} no soportado para take profit")
     
     # Usar la distancia base proporcionada para 3 USD de ganancia
-    take_profit_distance_base = TAKE_PROFIT_DISTANCES_NO_CONS[symbol]
+    take_profit_distance_base = instrument.take_profit_distance_no_cons
     
     # Sumar el spread a la distancia base para compensar su efecto y asegurar 3 USD de ganancia neta
     adjusted_take_profit_distance = take_profit_distance_base + spread
-    adjusted_take_profit_distance = max(adjusted_take_profit_distance, 0.00001)  # Asegurar un valor positivo
+    adjusted_take_profit_distance = max(adjusted_take_profit_distance, instrument.tick_size)  # Asegurar un valor positivo
     
     if direction == "BUY":
         take_profit = entry_price + adjusted_take_profit_distance
@@ -367,50 +1171,81 @@ def calculate_take_profit(entry_price, direction, profit_amount_usd, quantity, l
             send_telegram_message(f"⚠️ Take profit ajustado para {symbol} (SELL) a {take_profit} para cumplir con las restricciones del bróker. Ganancia objetivo: +${new_profit_amount} USD")
     
     logger.info(f"Take profit calculado para {symbol}: entry_price={entry_price}, direction={direction}, take_profit_distance_base={take_profit_distance_base}, spread={spread}, adjusted_take_profit_distance={adjusted_take_profit_distance}, take_profit={take_profit}, min_limit_distance={min_limit_distance}")
-    return round(take_profit, 5)
+    return round(take_profit, instrument.decimals)
 
-def calculate_profit_loss_from_stop_loss(pos):
+def calculate_profit_from_exit(pos, exit_price):
     entry_price = pos["entry_price"]
-    stop_loss = pos["stop_loss"]
     quantity = pos["quantity"]
-    leverage = 100.0
+    leverage = LEVERAGE
     if pos["direction"] == "BUY":
-        profit_loss = (stop_loss - entry_price) * quantity / leverage
+        profit_loss = (exit_price - entry_price) * quantity / leverage
     else:
-        profit_loss = (entry_price - stop_loss) * quantity / leverage
-    return round(profit_loss, 2)
-
-def calculate_current_profit(pos, current_bid, current_offer):
-    entry_price = pos["entry_price"]
-    quantity = pos["quantity"]
-    leverage = 100.0
-    if pos["direction"] == "BUY":
-        profit = (current_bid - entry_price) * quantity / leverage
-    else:
-        profit = (entry_price - current_offer) * quantity / leverage
-    logger.info(f"Cálculo de profit para {pos['direction']} {entry_price} -> {current_bid if pos['direction'] == 'BUY' else current_offer}: profit={profit} USD, quantity={quantity}, leverage={leverage}")
-    return profit
+        profit_loss = (entry_price - exit_price) * quantity / leverage
+    return profit_loss
 
 def convert_profit_to_usd(profit, symbol, current_bid, currency):
-    if currency == "USD":
-        return round(profit, 2)
-    elif currency == "MXN":
-        # Convertir MXN a USD usando el tipo de cambio actual (current_bid para USDMXN)
-        if symbol == "USDMXN":
-            profit_usd = profit / current_bid
-            return round(profit_usd, 2)
-    elif currency == "CAD":
-        # Convertir CAD a USD usando el tipo de cambio actual (1/current_bid para USDCAD)
-        if symbol == "USDCAD":
-            profit_usd = profit * (1 / current_bid)
-            return round(profit_usd, 2)
-    return round(profit, 2)
+    rate = get_usd_rate(currency)
+    # Si la caché no tiene el par, usar la cotización del propio símbolo cuando cotiza contra USD
+    if rate is None and current_bid and symbol == f"USD{currency}":
+        rate = 1 / current_bid
+    elif rate is None and current_bid and symbol == f"{currency}USD":
+        rate = current_bid
+    if rate is None:
+        # Sin tipo de cambio no se informa un importe en otra moneda como si fuera USD
+        logger.warning(f"Sin tipo de cambio reciente para {currency}: ganancia de {symbol} ({round(profit, 2)} {currency}) no disponible en USD")
+        return None
+    return round(profit * rate, 2)
+
+def format_profit_loss(profit_usd):
+    if profit_usd is None:
+        return "no disponible"
+    return f"+${profit_usd} USD" if profit_usd >= 0 else f"-${abs(profit_usd)} USD"
+
+def pre_trade_check(symbol, action, source):
+    # Devuelve el motivo de rechazo o None; solo usa estado en memoria, sin llamadas al bróker
+    instrument = INSTRUMENTS.get(symbol)
+    if instrument is None:
+        return f"Símbolo {symbol} no soportado"
+    if action not in ("buy", "sell"):
+        return f"Acción {action} no válida"
+    if consolidation_states.get(symbol, "Fin Consolidación") == "Inicio Consolidación" and source != "no cons":
+        return "El mercado está en un rango de consolidación. Se recomienda esperar a que el precio salga del rango."
+    pos = open_positions.get(symbol)
+    if pos is not None:
+        # Una señal opuesta cierra y reabre la posición, sin cambiar el número de posiciones abiertas
+        if pos["direction"] == action.upper():
+            return "Ya hay una operación abierta"
+    elif len(open_positions) >= MAX_OPEN_POSITIONS:
+        return f"Máximo de {MAX_OPEN_POSITIONS} posiciones abiertas alcanzado"
+    elapsed = time.time() - last_signal_times.get(symbol, 0.0)
+    # El periodo de espera no bloquea la señal opuesta que cierra la posición abierta
+    if pos is None and elapsed < SIGNAL_COOLDOWN_SECONDS:
+        return f"Última orden hace {elapsed:.0f}s, periodo de espera de {SIGNAL_COOLDOWN_SECONDS:.0f}s"
+    return None
+
+def check_exposure_limit(symbol, quantity):
+    # Se evalúa con la cotización recién obtenida y la cantidad real de la orden; sin tipo de cambio se rechaza
+    if MAX_EXPOSURE_USD <= 0:
+        return None
+    if portfolio.unpriced:
+        return f"Sin tipo de cambio reciente para valorar {', '.join(sorted(portfolio.unpriced))}, no se puede verificar el límite de exposición"
+    base_currency, quote_currency = split_currencies(symbol)
+    base_rate = get_usd_rate(base_currency)
+    if base_rate is None:
+        return f"Sin tipo de cambio reciente para {base_currency}, no se puede verificar el límite de exposición"
+    new_exposure_usd = quantity * base_rate
+    if portfolio.total_exposure_usd + new_exposure_usd > MAX_EXPOSURE_USD:
+        return f"Exposición total de {round(portfolio.total_exposure_usd + new_exposure_usd, 2)} USD supera el límite de {MAX_EXPOSURE_USD} USD"
+    return None
+
+def record_signal_time(symbol):
+    # El periodo de espera solo cuenta desde una orden ejecutada
+    last_signal_times[symbol] = time.time()
+    persist_state("last_signal_times", {symbol: last_signal_times[symbol]})
 
 def get_active_trades(cst: str, x_security_token: str, symbol: str):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
-    response = requests.get(f"{CAPITAL_API_URL}/positions", headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error al obtener posiciones: {response.text}")
+    response = broker_request("GET", "/positions", headers, "Error al obtener posiciones")
     trade_count = {"buy": 0, "sell": 0}
     for position in response.json().get("positions", []):
         if position["market"]["epic"] == symbol:
@@ -419,14 +1254,12 @@ def get_active_trades(cst: str, x_security_token: str, symbol: str):
 
 def get_position_deal_id(cst: str, x_security_token: str, epic: str, direction: str):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
-    response = requests.get(f"{CAPITAL_API_URL}/positions", headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"Error al obtener posiciones: {response.text}")
+    response = broker_request("GET", "/positions", headers, "Error al obtener posiciones")
     positions = response.json().get("positions", [])
     for position in positions:
         if position["market"]["epic"] == epic and position["position"]["direction"] == direction:
             return position["position"]["dealId"]
-    raise Exception(f"No se encontró posición activa para {epic} en dirección {direction}")
+    raise BrokerError("error.position.notfound", f"No se encontró posición activa para {epic} en dirección {direction}")
 
 def place_order(cst: str, x_security_token: str, direction: str, epic: str, size: float, stop_level: float = None, profit_level: float = None):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token, "Content-Type": "application/json"}
@@ -444,93 +1277,234 @@ def place_order(cst: str, x_security_token: str, direction: str, epic: str, size
     
     logger.info(f"Enviando orden para {epic}: payload={json.dumps(payload, indent=2)}")
     try:
-        response = requests.post(f"{CAPITAL_API_URL}/positions", headers=headers, json=payload, timeout=10)
-        if response.status_code != 200:
-            error_msg = response.text
-            logger.error(f"Error en place_order: {error_msg}")
-            raise Exception(f"Error al ejecutar la orden: {error_msg}")
-        response_json = response.json()
-        logger.info(f"Respuesta de place_order: {json.dumps(response_json, indent=2)}")
-    except Exception as e:
-        raise Exception(f"Error al ejecutar la orden: {str(e)}")
+        response = broker_request("POST", "/positions", headers, "Error al ejecutar la orden", payload=payload)
+    except BrokerError as e:
+        logger.error(f"Error en place_order: {e}")
+        raise
+    response_json = response.json()
+    logger.info(f"Respuesta de place_order: {json.dumps(response_json, indent=2)}")
     
     deal_key = "dealReference" if "dealReference" in response_json else "dealId"
     if deal_key not in response_json:
         logger.error(f"Respuesta inesperada: {response_json}")
-        raise Exception(f"No se encontró '{deal_key}' en la respuesta: {response_json}")
+        raise BrokerError("error.response.unexpected", f"No se encontró '{deal_key}' en la respuesta: {response_json}")
     
     return response_json[deal_key]
 
 def close_position(cst: str, x_security_token: str, deal_id: str, epic: str, size: float, entry_price: float, direction: str, quantity: float, currency: str, current_bid: float, current_offer: float):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token}
     try:
-        response = requests.delete(f"{CAPITAL_API_URL}/positions/{deal_id}", headers=headers, timeout=10)
-        if response.status_code != 200:
-            error_msg = response.text
-            logger.error(f"Error en close_position: {error_msg}")
-            raise Exception(f"Error al cerrar posición: {error_msg}")
-        response_json = response.json()
-        deal_ref = response_json.get("dealReference")
-        # Obtener la confirmación del cierre
-        confirmation = get_deal_confirmation(cst, x_security_token, deal_ref)
-        if "profit" in confirmation:
-            profit = confirmation["profit"]
-            profit_currency = confirmation["currency"]
-            profit_usd = convert_profit_to_usd(profit, epic, current_bid, profit_currency)
-        else:
-            exit_price = confirmation["level"]
-            leverage = 100.0
-            if direction == "BUY":
-                profit = (exit_price - entry_price) * quantity / leverage
-            else:
-                profit = (entry_price - exit_price) * quantity / leverage
-            profit_usd = convert_profit_to_usd(profit, epic, current_bid, currency)
-        return deal_ref, profit_usd
-    except Exception as e:
-        raise Exception(f"Error al cerrar posición: {str(e)}")
+        response = broker_request("DELETE", f"/positions/{deal_id}", headers, "Error al cerrar posición")
+    except BrokerError as e:
+        logger.error(f"Error en close_position: {e}")
+        raise
+    deal_ref = response.json().get("dealReference")
+    # Obtener la confirmación del cierre
+    confirmation = get_deal_confirmation(cst, x_security_token, deal_ref)
+    if "profit" in confirmation:
+        profit = confirmation["profit"]
+        profit_currency = confirmation["currency"]
+        profit_usd = convert_profit_to_usd(profit, epic, current_bid, profit_currency)
+    else:
+        exit_price = confirmation["level"]
+        profit = calculate_profit_from_exit({"entry_price": entry_price, "direction": direction, "quantity": quantity}, exit_price)
+        profit_usd = convert_profit_to_usd(profit, epic, current_bid, currency)
+    return deal_ref, profit_usd
 
 def update_stop_loss(cst: str, x_security_token: str, deal_id: str, new_stop_loss: float, symbol: str):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token, "Content-Type": "application/json"}
-    new_stop_loss = round(new_stop_loss, 5)  # Todos los pares usan 5 decimales
+    new_stop_loss = round(new_stop_loss, price_decimals(symbol))
     payload = {"stopLevel": new_stop_loss}
-    response = requests.put(f"{CAPITAL_API_URL}/positions/{deal_id}", headers=headers, json=payload)
-    if response.status_code != 200:
-        error_msg = response.json() if response.text else "Respuesta vacía"
-        logger.error(f"Error al actualizar stop loss: {error_msg}")
-        raise Exception(f"Error al actualizar stop loss: {error_msg}")
+    try:
+        broker_request("PUT", f"/positions/{deal_id}", headers, "Error al actualizar stop loss", payload=payload)
+    except BrokerError as e:
+        logger.error(f"{e} [{e.code}]")
+        raise
 
 def update_take_profit(cst: str, x_security_token: str, deal_id: str, new_take_profit: float, symbol: str):
     headers = {"X-CAP-API-KEY": API_KEY, "CST": cst, "X-SECURITY-TOKEN": x_security_token, "Content-Type": "application/json"}
-    new_take_profit = round(new_take_profit, 5)  # Todos los pares usan 5 decimales
+    new_take_profit = round(new_take_profit, price_decimals(symbol))
     payload = {"profitLevel": new_take_profit}
     logger.info(f"Actualizando take profit para {symbol} (dealId: {deal_id}): payload={json.dumps(payload, indent=2)}")
-    response = requests.put(f"{CAPITAL_API_URL}/positions/{deal_id}", headers=headers, json=payload)
-    if response.status_code != 200:
-        error_msg = response.json() if response.text else "Respuesta vacía"
-        logger.error(f"Error al actualizar take profit: {error_msg}")
-        raise Exception(f"Error al actualizar take profit: {error_msg}")
+    try:
+        broker_request("PUT", f"/positions/{deal_id}", headers, "Error al actualizar take profit", payload=payload)
+    except BrokerError as e:
+        logger.error(f"{e} [{e.code}]")
+        raise
     logger.info(f"Take profit actualizado para {symbol}: {new_take_profit}")
 
+def position_row(symbol, pos, quote):
+    instrument = INSTRUMENTS.get(symbol)
+    stop_loss = pos.get("stop_loss")
+    take_profit = pos.get("take_profit")
+    return (
+        1.0 if pos["direction"] == "BUY" else -1.0,
+        pos["entry_price"],
+        np.nan if stop_loss is None else stop_loss,
+        np.nan if take_profit is None else take_profit,
+        # UPL en USD revaluado con la última cotización; el upl del bróker solo si el símbolo no está en el agregador
+        portfolio.upl_usd(symbol, pos.get("upl", 0.0)),
+        pos.get("highest_price", pos["entry_price"]),
+        pos.get("lowest_price", pos["entry_price"]),
+        pos.get("trailing_active", False),
+        RULE_INDEX.get(pos.get("source"), len(POSITION_RULES)),
+        instrument.distance_per_usd if instrument is not None else LEVERAGE / pos["quantity"],
+        10.0 ** price_decimals(symbol),
+        quote[1],
+        quote[2],
+        quote[4]
+    )
+
+def evaluate_position_rules(positions, quotes):
+    # Evalúa las reglas de todas las posiciones en una sola pasada vectorizada.
+    # Devuelve el estado de trailing de las posiciones donde cambió y las acciones (ajuste de stop o cierre) a ejecutar.
+    symbols = [symbol for symbol in positions if symbol in quotes]
+    if not symbols:
+        return {}, {}
+    table = np.array([position_row(symbol, positions[symbol], quotes[symbol]) for symbol in symbols], dtype=POSITION_DTYPE)
+    sign = table["sign"]
+    entry = table["entry_price"]
+    stop = table["stop_loss"]
+    take_profit = table["take_profit"]
+    profit = table["upl"]
+    scale = table["scale"]
+
+    # Extremos alcanzados con el precio de cierre de cada dirección (bid para BUY, offer para SELL)
+    mark_raw = np.where(sign > 0, table["bid"], table["offer"])
+    highest = np.maximum(table["highest_price"], mark_raw)
+    lowest = np.minimum(table["lowest_price"], mark_raw)
+    bid = np.round(table["bid"] * scale) / scale
+    offer = np.round(table["offer"] * scale) / scale
+    mark = np.where(sign > 0, bid, offer)
+
+    # Stop más ajustado que permite el bróker y recorte de cada objetivo a ese límite
+    stop_limit = np.where(sign > 0, bid - table["min_stop_distance"], offer + table["min_stop_distance"])
+    def clip_to_limit(target):
+        return np.round(np.where(sign > 0, np.minimum(target, stop_limit), np.maximum(target, stop_limit)) * scale) / scale
+
+    break_even_usd, trailing_start_usd, trailing_distance_usd = RULE_THRESHOLDS[table["rule"]].T
+    with np.errstate(invalid="ignore"):
+        # Break-even: stop al precio de entrada
+        break_even_stop = clip_to_limit(entry)
+        break_even = (profit >= break_even_usd) & (stop != entry) & (sign * (break_even_stop - stop) > 0)
+        # Trailing stop a la distancia configurada del extremo alcanzado
+        trailing_active = table["trailing_active"] | (profit >= trailing_start_usd)
+        extreme = np.where(sign > 0, highest, lowest)
+        trailing_stop = clip_to_limit(extreme - sign * trailing_distance_usd * table["distance_per_usd"])
+        trailing = trailing_active & ~np.isnan(trailing_distance_usd) & (sign * (trailing_stop - stop) > 0)
+        # Cierre por take profit
+        close = RULE_CLOSE_AT_TAKE_PROFIT[table["rule"]] & (sign * (mark - take_profit) >= 0)
+    use_trailing = trailing & (~break_even | (sign * (trailing_stop - break_even_stop) >= 0))
+    new_stop = np.where(use_trailing, trailing_stop, break_even_stop)
+    changed = (highest != table["highest_price"]) | (lowest != table["lowest_price"]) | (trailing_active != table["trailing_active"])
+
+    # Solo se recorren en Python las filas con cambios o acciones
+    states = {}
+    actions = {}
+    for i in np.flatnonzero(changed | close | break_even | trailing):
+        symbol = symbols[i]
+        deal_id = positions[symbol]["dealId"]
+        if changed[i]:
+            states[symbol] = {
+                "dealId": deal_id,
+                "highest_price": float(highest[i]),
+                "lowest_price": float(lowest[i]),
+                "trailing_active": bool(trailing_active[i])
+            }
+        if close[i]:
+            actions[symbol] = {"type": "close", "dealId": deal_id, "reason": "take profit", "price": float(mark[i])}
+        elif break_even[i] or trailing[i]:
+            actions[symbol] = {"type": "amend_stop", "dealId": deal_id, "reason": "trailing" if use_trailing[i] else "break_even", "stop_loss": float(new_stop[i])}
+    return states, actions
+
+def apply_position_action(cst: str, x_security_token: str, symbol: str, pos: dict, action: dict, quote):
+    global open_positions
+    current_bid, current_offer = quote[1], quote[2]
+    profit_usd = round(portfolio.upl_usd(symbol, pos.get("upl", 0.0)), 2)
+    if action["type"] == "close":
+        deal_ref, profit_usd = close_position(
+            cst, x_security_token, pos["dealId"], symbol, pos.get("size", pos["quantity"]),
+            entry_price=pos["entry_price"], direction=pos["direction"],
+            quantity=pos["quantity"], currency=pos["currency"],
+            current_bid=current_bid, current_offer=current_offer
+        )
+        send_telegram_message(f"🔒 Posición cerrada por {action['reason']} para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia/pérdida: {format_profit_loss(profit_usd)}")
+        logger.info(f"Posición cerrada por {action['reason']} para {symbol}, profit_loss: {profit_usd} USD")
+        journal_event("close", symbol, pos, price=action["price"], pnl_usd=profit_usd)
+        del open_positions[symbol]
+        portfolio.remove(symbol)
+        return
+    new_stop_loss = action["stop_loss"]
+    try:
+        update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
+    except BrokerError as e:
+        # El bróker indica el nivel máximo (BUY) o mínimo (SELL) permitido para el stop
+        if e.code not in ("error.invalid.stoploss.maxvalue", "error.invalid.stoploss.minvalue") or not isinstance(e.value, float):
+            raise
+        logger.warning(f"Ajustando stop loss de {symbol} al límite del bróker {e.value} basado en el error: {e}")
+        new_stop_loss = round(min(new_stop_loss, e.value) if pos["direction"] == "BUY" else max(new_stop_loss, e.value), price_decimals(symbol))
+        update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
+    pos["stop_loss"] = new_stop_loss
+    journal_event("amend", symbol, pos)
+    if action["reason"] == "break_even":
+        logger.info(f"Stop loss ajustado a 0 dólares de pérdida para {symbol}: {new_stop_loss}, profit_usd={profit_usd}")
+        send_telegram_message(f"🔄 Stop loss ajustado a 0 dólares de pérdida para {symbol}: {new_stop_loss}, profit: +${profit_usd} USD")
+    else:
+        logger.info(f"Trailing stop actualizado para {symbol} ({pos['direction']}): {new_stop_loss}, profit_usd={profit_usd}")
+        send_telegram_message(f"🔄 Trailing stop actualizado para {symbol} ({pos['direction']}): {new_stop_loss}, profit: +${profit_usd} USD")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global open_positions, cst, x_security_token
+    global open_positions, cst, x_security_token, activity_cursor, consolidation_states
     logger.setLevel(logging.INFO)
-    open_positions = load_positions()
-    cst, x_security_token = authenticate()
-    cst, x_security_token = sync_open_positions(cst, x_security_token)
-    
-    # Sincronizar estados de consolidación al iniciar
-    last_signal_15m = load_signal()
-    # Inicializar estados para los símbolos operados si no están presentes
-    for symbol in SYMBOLS_OPERATED:
-        if symbol not in last_signal_15m:
-            last_signal_15m[symbol] = "Fin Consolidación"  # Estado por defecto
-    save_signal(last_signal_15m)
-    logger.info(f"Estados de consolidación sincronizados al inicio: {last_signal_15m}")
+    reconcile_task = None
+    if restore_state():
+        # Arranque en caliente: atender señales de inmediato y reconciliar con el bróker en segundo plano
+        for symbol in SYMBOLS_OPERATED:
+            if symbol not in consolidation_states:
+                consolidation_states[symbol] = "Fin Consolidación"  # Estado por defecto
+        logger.info(f"Estado local restaurado: {len(open_positions)} posiciones, consolidación: {consolidation_states}")
+        reconcile_task = asyncio.create_task(reconcile_with_broker())
+    else:
+        open_positions = load_positions()
+        activity_cursor = load_activity_cursor()
+        cst, x_security_token = authenticate()
+        cst, x_security_token = sync_open_positions(cst, x_security_token)
+        
+        # Sincronizar estados de consolidación al iniciar
+        last_signal_15m = load_signal()
+        # Inicializar estados para los símbolos operados si no están presentes
+        for symbol in SYMBOLS_OPERATED:
+            if symbol not in last_signal_15m:
+                last_signal_15m[symbol] = "Fin Consolidación"  # Estado por defecto
+        save_signal(last_signal_15m)
+        persist_state("consolidation_states", last_signal_15m)
+        consolidation_states = last_signal_15m
+        logger.info(f"Estados de consolidación sincronizados al inicio: {last_signal_15m}")
     
-    logger.info("🚀 Bot iniciado correctamente.")
+    # Cada worker compite por el liderazgo; solo el líder ejecuta el monitoreo
+    monitor_task = asyncio.create_task(run_monitor_when_leader())
+    logger.info(f"🚀 Bot iniciado correctamente (worker {WORKER_ID}).")
     yield
     logger.info("Cerrando aplicación...")
+    monitor_task.cancel()
+    if reconcile_task is not None:
+        reconcile_task.cancel()
+    await asyncio.to_thread(shared_state.release, "monitor", WORKER_ID)
+
+async def reconcile_with_broker():
+    global cst, x_security_token
+    try:
+        # Bajo el lock del estado local: el monitor y los webhooks de este proceso esperan la reconciliación sin bloquear el event loop
+        cst, x_security_token = await asyncio.to_thread(run_with_local_state, authenticate_and_sync)
+        logger.info(f"Reconciliación con el bróker completada: {len(open_positions)} posiciones")
+    except Exception as e:
+        logger.error(f"Error en la reconciliación con el bróker: {e}")
+        await asyncio.to_thread(send_telegram_message, f"❌ Error en la reconciliación con el bróker tras el reinicio: {str(e)}")
+
+def authenticate_and_sync():
+    new_cst, new_x_security_token = authenticate()
+    return sync_open_positions(new_cst, new_x_security_token)
 
 app = FastAPI(lifespan=lifespan)
 
@@ -542,356 +1516,339 @@ class Signal(BaseModel):
     timeframe: str = "1m"
     loss_amount_usd: float = 10.0
 
-@app.post("/webhook")
-async def webhook(request: Request):
+def execute_trade_signal(action, symbol, quantity, source, loss_amount_usd, background_tasks):
     global open_positions, cst, x_security_token
+    # Filtro de riesgo en memoria: las señales rechazadas no llegan al bróker
+    rejection_reason = pre_trade_check(symbol, action, source)
+    if rejection_reason is not None:
+        rejection_message = f"⚠️ Operación rechazada para {symbol}: {rejection_reason}"
+        logger.info(rejection_message)
+        background_tasks.add_task(send_telegram_message, rejection_message)
+        return {"message": rejection_message}
+    
     if cst is None or x_security_token is None:
-        cst, x_security_token = authenticate()
+        session = shared_state.get_many(["session"]).get("session")
+        if session:
+            cst, x_security_token = session["cst"], session["x_security_token"]
+        else:
+            cst, x_security_token = authenticate()
+    cst, x_security_token = sync_open_positions(cst, x_security_token)
     
+    min_size, current_bid, current_offer, spread, min_stop_distance, min_limit_distance, max_stop_distance = get_market_details(cst, x_security_token, symbol)
+    adjusted_quantity = max(quantity, min_size)
+    if adjusted_quantity != quantity:
+        logger.info(f"Ajustando quantity de {quantity} a {adjusted_quantity} para cumplir con el tamaño mínimo")
+    if symbol not in open_positions:
+        rejection_reason = check_exposure_limit(symbol, adjusted_quantity)
+        if rejection_reason is not None:
+            rejection_message = f"⚠️ Operación rechazada para {symbol}: {rejection_reason}"
+            logger.info(rejection_message)
+            background_tasks.add_task(send_telegram_message, rejection_message)
+            return {"message": rejection_message}
+    
+    entry_price = current_bid if action == "buy" else current_offer
+    entry_price = round(entry_price, price_decimals(symbol))
+    initial_stop_loss = calculate_valid_stop_loss(
+        entry_price=entry_price,
+        direction=action.upper(),
+        loss_amount_usd=loss_amount_usd,
+        quantity=adjusted_quantity,
+        leverage=LEVERAGE,
+        min_stop_distance=min_stop_distance,
+        max_stop_distance=max_stop_distance,
+        symbol=symbol,
+        spread=spread,
+        source=source,
+        current_bid=current_bid,
+        current_offer=current_offer
+    )
+    take_profit = calculate_take_profit(
+        entry_price=entry_price,
+        direction=action.upper(),
+        profit_amount_usd=3.0,  # Ajustado a 3 USD para todos los símbolos
+        quantity=adjusted_quantity,
+        leverage=LEVERAGE,
+        min_limit_distance=min_limit_distance,
+        symbol=symbol,
+        source=source,
+        current_bid=current_bid,
+        current_offer=current_offer,
+        spread=spread
+    )
+    logger.info(f"Initial stop loss y take profit calculados para {symbol}: entry_price={entry_price}, initial_stop_loss={initial_stop_loss}, take_profit={take_profit}")
+    
+    # open_positions se acaba de sincronizar con el bróker, no hace falta otra consulta de posiciones
+    if symbol in open_positions:
+        pos = open_positions[symbol]
+        opposite_action = "sell" if pos["direction"] == "BUY" else "buy"
+        if action == opposite_action:
+            logger.info(f"Intentando cerrar posición para {symbol} con dealId: {pos['dealId']}")
+            try:
+                deal_ref, profit_usd = close_position(
+                    cst, x_security_token, pos["dealId"], symbol, adjusted_quantity,
+                    entry_price=pos["entry_price"], direction=pos["direction"],
+                    quantity=pos["quantity"], currency=pos["currency"],
+                    current_bid=current_bid, current_offer=current_offer
+                )
+                send_telegram_message(f"🔒 Posición cerrada para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia/pérdida: {format_profit_loss(profit_usd)}")
+                logger.info(f"Posición cerrada para {symbol} por señal opuesta, profit_loss: {profit_usd} USD")
+                journal_event("close", symbol, pos, pnl_usd=profit_usd)
+            except Exception as e:
+                logger.error(f"Error al cerrar posición: {e}")
+                send_telegram_message(f"🔒 Posición cerrada para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia/pérdida no calculada debido a error: {str(e)}")
+                raise HTTPException(status_code=500, detail=str(e))
+            finally:
+                if symbol in open_positions:
+                    del open_positions[symbol]
+                    portfolio.remove(symbol)
+                
+                try:
+                    new_active_trades = get_active_trades(cst, x_security_token, symbol)
+                    if new_active_trades["buy"] == 0 and new_active_trades["sell"] == 0:
+                        # Abrir la posición con stopLevel y profitLevel incluidos
+                        deal_ref = place_order(
+                            cst, x_security_token, action.upper(), symbol, adjusted_quantity,
+                            stop_level=initial_stop_loss, profit_level=take_profit
+                        )
+                        deal_id = get_position_deal_id(cst, x_security_token, symbol, action.upper())
+                        # Verificar que el stop loss y take profit se hayan configurado correctamente
+                        position_details = get_position_details(cst, x_security_token, symbol)
+                        if position_details:
+                            actual_stop_loss = position_details["stop_loss"]
+                            actual_take_profit = position_details["take_profit"]
+                            if actual_stop_loss != initial_stop_loss:
+                                logger.warning(f"Stop loss no configurado correctamente al abrir posición para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
+                                send_telegram_message(f"⚠️ Stop loss no configurado correctamente para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
+                            if take_profit is not None and actual_take_profit != take_profit:
+                                logger.warning(f"Take profit no configurado correctamente al abrir posición para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
+                                send_telegram_message(f"⚠️ Take profit no configurado correctamente para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
+                        logger.info(f"Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit}, dealId: {deal_id}")
+                        send_telegram_message(f"📈 Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit} (dealId: {deal_id})")
+                        open_positions[symbol] = {
+                            "direction": action.upper(),
+                            "entry_price": entry_price,
+                            "stop_loss": initial_stop_loss,
+                            "dealId": deal_id,
+                            "quantity": adjusted_quantity,
+                            "size": adjusted_quantity,
+                            "spread_at_open": spread,
+                            "source": source,
+                            "take_profit": take_profit,
+                            "highest_price": entry_price,
+                            "lowest_price": entry_price,
+                            "trailing_active": False,
+                            "currency": INSTRUMENTS[symbol].quote_currency
+                        }
+                        save_positions(open_positions)
+                        record_signal_time(symbol)
+                        journal_event("open", symbol, open_positions[symbol], price=entry_price)
+                        portfolio.revalue(symbol, open_positions[symbol], current_bid, current_offer)
+                        return {"message": f"Posición cerrada y nueva orden {action.upper()} ejecutada para {symbol}"}
+                    else:
+                        raise Exception(f"No se pudo abrir la nueva orden: aún hay posiciones abiertas para {symbol}")
+                except Exception as e:
+                    logger.error(f"Error al abrir nueva posición para {symbol}: {e}")
+                    error_message = f"Posición cerrada, pero error al abrir nueva orden: {str(e)}"
+                    send_telegram_message(f"❌ {error_message}")
+                    return {"message": error_message}
+        logger.info(f"Operación rechazada: Ya hay una operación abierta para {symbol}")
+        send_telegram_message(f"⚠️ Operación rechazada para {symbol}: Ya hay una operación abierta")
+        return {"message": f"Operación rechazada: Ya hay una operación abierta para {symbol}"}
+    
+    # Abrir la posición con stopLevel y profitLevel incluidos
+    deal_ref = place_order(
+        cst, x_security_token, action.upper(), symbol, adjusted_quantity,
+        stop_level=initial_stop_loss, profit_level=take_profit
+    )
+    deal_id = get_position_deal_id(cst, x_security_token, symbol, action.upper())
+    # Verificar que el stop loss y take profit se hayan configurado correctamente
+    position_details = get_position_details(cst, x_security_token, symbol)
+    if position_details:
+        actual_stop_loss = position_details["stop_loss"]
+        actual_take_profit = position_details["take_profit"]
+        if actual_stop_loss != initial_stop_loss:
+            logger.warning(f"Stop loss no configurado correctamente al abrir posición para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
+            send_telegram_message(f"⚠️ Stop loss no configurado correctamente para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
+        if take_profit is not None and actual_take_profit != take_profit:
+            logger.warning(f"Take profit no configurado correctamente al abrir posición para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
+            send_telegram_message(f"⚠️ Take profit no configurado correctamente para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
+    logger.info(f"Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit}, dealId: {deal_id}")
+    send_telegram_message(f"📈 Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit} (dealId: {deal_id})")
+    
+    open_positions[symbol] = {
+        "direction": action.upper(),
+        "entry_price": entry_price,
+        "stop_loss": initial_stop_loss,
+        "dealId": deal_id,
+        "quantity": adjusted_quantity,
+        "size": adjusted_quantity,
+        "spread_at_open": spread,
+        "source": source,
+        "take_profit": take_profit,
+        "highest_price": entry_price,
+        "lowest_price": entry_price,
+        "trailing_active": False,
+        "currency": INSTRUMENTS[symbol].quote_currency
+    }
+    save_positions(open_positions)
+    record_signal_time(symbol)
+    journal_event("open", symbol, open_positions[symbol], price=entry_price)
+    portfolio.revalue(symbol, open_positions[symbol], current_bid, current_offer)
+    
+    return {"message": "Orden ejecutada correctamente"}
+
+def run_with_local_state(func, *args):
+    # Se ejecuta en un hilo (asyncio.to_thread) para no bloquear el event loop con llamadas al bróker, Drive o SQLite
+    with local_state_lock:
+        return func(*args)
+
+def update_consolidation_state(action, symbol):
+    load_shared_state()
+    if "inicio" in action.lower():
+        consolidation_states[symbol] = "Inicio Consolidación"
+    elif "fin" in action.lower():
+        consolidation_states[symbol] = "Fin Consolidación"
+    if symbol in consolidation_states:
+        persist_state("consolidation_states", {symbol: consolidation_states[symbol]})
+    save_signal(consolidation_states)
+    logger.info(f"Estado de consolidación actualizado para {symbol}: {consolidation_states.get(symbol)}")
+    return {"message": f"Última señal de 15m registrada para {symbol}: {consolidation_states.get(symbol)}"}
+
+def process_trade_signal(action, symbol, quantity, source, loss_amount_usd, background_tasks):
+    # Lock por símbolo compartido entre workers: una sola señal por símbolo a la vez
+    with shared_state.lease(f"symbol:{symbol}", SYMBOL_LOCK_TTL, SYMBOL_LOCK_TIMEOUT):
+        load_shared_state()
+        return execute_trade_signal(action, symbol, quantity, source, loss_amount_usd, background_tasks)
+
+@app.post("/webhook")
+async def webhook(request: Request, background_tasks: BackgroundTasks):
     data = await request.json()
     try:
         signal = Signal(**data)
         action, symbol, quantity, source, timeframe, loss_amount_usd = signal.action.lower(), signal.symbol, signal.quantity, signal.source, signal.timeframe, signal.loss_amount_usd
-        last_signal_15m = load_signal()
         
         # Actualizar estado de consolidación si la señal es de 15m
         if timeframe == "15m":
-            if "inicio" in action.lower():
-                last_signal_15m[symbol] = "Inicio Consolidación"
-            elif "fin" in action.lower():
-                last_signal_15m[symbol] = "Fin Consolidación"
-            save_signal(last_signal_15m)
-            logger.info(f"Estado de consolidación actualizado para {symbol}: {last_signal_15m[symbol]}")
-            return {"message": f"Última señal de 15m registrada para {symbol}: {last_signal_15m[symbol]}"}
-        
-        # Verificar el estado de consolidación antes de operar
-        market_state = last_signal_15m.get(symbol, "Fin Consolidación")
-        if market_state == "Inicio Consolidación" and source != "no cons":
-            rejection_message = (
-                f"⚠️ Operación rechazada para {symbol}: El mercado está en un rango de consolidación. "
-                "Se recomienda esperar a que el precio salga del rango."
-            )
-            logger.info(rejection_message)
-            send_telegram_message(rejection_message)
-            return {"message": rejection_message}
-        
-        cst, x_security_token = sync_open_positions(cst, x_security_token)
-        
-        min_size, current_bid, current_offer, spread, min_stop_distance, min_limit_distance, max_stop_distance = get_market_details(cst, x_security_token, symbol)
-        adjusted_quantity = max(quantity, min_size)
-        if adjusted_quantity != quantity:
-            logger.info(f"Ajustando quantity de {quantity} a {adjusted_quantity} para cumplir con el tamaño mínimo")
-        
-        entry_price = current_bid if action == "buy" else current_offer
-        entry_price = round(entry_price, 5)
-        initial_stop_loss = calculate_valid_stop_loss(
-            entry_price=entry_price,
-            direction=action.upper(),
-            loss_amount_usd=loss_amount_usd,
-            quantity=adjusted_quantity,
-            leverage=100.0,
-            min_stop_distance=min_stop_distance,
-            max_stop_distance=max_stop_distance,
-            symbol=symbol,
-            spread=spread,
-            source=source,
-            current_bid=current_bid,
-            current_offer=current_offer
-        )
-        take_profit = calculate_take_profit(
-            entry_price=entry_price,
-            direction=action.upper(),
-            profit_amount_usd=3.0,  # Ajustado a 3 USD para todos los símbolos
-            quantity=adjusted_quantity,
-            leverage=100.0,
-            min_limit_distance=min_limit_distance,
-            symbol=symbol,
-            source=source,
-            current_bid=current_bid,
-            current_offer=current_offer,
-            spread=spread
-        )
-        logger.info(f"Initial stop loss y take profit calculados para {symbol}: entry_price={entry_price}, initial_stop_loss={initial_stop_loss}, take_profit={take_profit}")
-        
-        active_trades = get_active_trades(cst, x_security_token, symbol)
-        if active_trades["buy"] > 0 or active_trades["sell"] > 0:
-            if symbol in open_positions:
-                pos = open_positions[symbol]
-                opposite_action = "sell" if pos["direction"] == "BUY" else "buy"
-                if action == opposite_action:
-                    logger.info(f"Intentando cerrar posición para {symbol} con dealId: {pos['dealId']}")
-                    try:
-                        deal_ref, profit_usd = close_position(
-                            cst, x_security_token, pos["dealId"], symbol, adjusted_quantity,
-                            entry_price=pos["entry_price"], direction=pos["direction"],
-                            quantity=pos["quantity"], currency=pos["currency"],
-                            current_bid=current_bid, current_offer=current_offer
-                        )
-                        profit_loss_message = f"+${profit_usd} USD" if profit_usd >= 0 else f"-${abs(profit_usd)} USD"
-                        send_telegram_message(f"🔒 Posición cerrada para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia/pérdida: {profit_loss_message}")
-                        logger.info(f"Posición cerrada para {symbol} por señal opuesta, profit_loss: {profit_usd} USD")
-                    except Exception as e:
-                        logger.error(f"Error al cerrar posición: {e}")
-                        send_telegram_message(f"🔒 Posición cerrada para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia/pérdida no calculada debido a error: {str(e)}")
-                        raise HTTPException(status_code=500, detail=str(e))
-                    finally:
-                        if symbol in open_positions:
-                            del open_positions[symbol]
-                        
-                        try:
-                            new_active_trades = get_active_trades(cst, x_security_token, symbol)
-                            if new_active_trades["buy"] == 0 and new_active_trades["sell"] == 0:
-                                # Abrir la posición con stopLevel y profitLevel incluidos
-                                deal_ref = place_order(
-                                    cst, x_security_token, action.upper(), symbol, adjusted_quantity,
-                                    stop_level=initial_stop_loss, profit_level=take_profit
-                                )
-                                deal_id = get_position_deal_id(cst, x_security_token, symbol, action.upper())
-                                # Verificar que el stop loss y take profit se hayan configurado correctamente
-                                position_details = get_position_details(cst, x_security_token, symbol)
-                                if position_details:
-                                    actual_stop_loss = position_details["stop_loss"]
-                                    actual_take_profit = position_details["take_profit"]
-                                    if actual_stop_loss != initial_stop_loss:
-                                        logger.warning(f"Stop loss no configurado correctamente al abrir posición para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
-                                        send_telegram_message(f"⚠️ Stop loss no configurado correctamente para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
-                                    if take_profit is not None and actual_take_profit != take_profit:
-                                        logger.warning(f"Take profit no configurado correctamente al abrir posición para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
-                                        send_telegram_message(f"⚠️ Take profit no configurado correctamente para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
-                                logger.info(f"Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit}, dealId: {deal_id}")
-                                send_telegram_message(f"📈 Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit} (dealId: {deal_id})")
-                                open_positions[symbol] = {
-                                    "direction": action.upper(),
-                                    "entry_price": entry_price,
-                                    "stop_loss": initial_stop_loss,
-                                    "dealId": deal_id,
-                                    "quantity": adjusted_quantity,
-                                    "spread_at_open": spread,
-                                    "source": source,
-                                    "take_profit": take_profit,
-                                    "highest_price": entry_price,
-                                    "lowest_price": entry_price,
-                                    "trailing_active": False,
-                                    "currency": "USD" if symbol == "EURUSD" else ("MXN" if symbol == "USDMXN" else "CAD")
-                                }
-                                save_positions(open_positions)
-                                return {"message": f"Posición cerrada y nueva orden {action.upper()} ejecutada para {symbol}"}
-                            else:
-                                raise Exception(f"No se pudo abrir la nueva orden: aún hay posiciones abiertas para {symbol}")
-                        except Exception as e:
-                            logger.error(f"Error al abrir nueva posición para {symbol}: {e}")
-                            error_message = f"Posición cerrada, pero error al abrir nueva orden: {str(e)}"
-                            send_telegram_message(f"❌ {error_message}")
-                            return {"message": error_message}
-            logger.info(f"Operación rechazada: Ya hay una operación abierta para {symbol}")
-            send_telegram_message(f"⚠️ Operación rechazada para {symbol}: Ya hay una operación abierta")
-            return {"message": f"Operación rechazada: Ya hay una operación abierta para {symbol}"}
+            return await asyncio.to_thread(run_with_local_state, update_consolidation_state, action, symbol)
         
-        # Abrir la posición con stopLevel y profitLevel incluidos
-        deal_ref = place_order(
-            cst, x_security_token, action.upper(), symbol, adjusted_quantity,
-            stop_level=initial_stop_loss, profit_level=take_profit
-        )
-        deal_id = get_position_deal_id(cst, x_security_token, symbol, action.upper())
-        # Verificar que el stop loss y take profit se hayan configurado correctamente
-        position_details = get_position_details(cst, x_security_token, symbol)
-        if position_details:
-            actual_stop_loss = position_details["stop_loss"]
-            actual_take_profit = position_details["take_profit"]
-            if actual_stop_loss != initial_stop_loss:
-                logger.warning(f"Stop loss no configurado correctamente al abrir posición para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
-                send_telegram_message(f"⚠️ Stop loss no configurado correctamente para {symbol}: esperado={initial_stop_loss}, actual={actual_stop_loss}")
-            if take_profit is not None and actual_take_profit != take_profit:
-                logger.warning(f"Take profit no configurado correctamente al abrir posición para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
-                send_telegram_message(f"⚠️ Take profit no configurado correctamente para {symbol}: esperado={take_profit}, actual={actual_take_profit}")
-        logger.info(f"Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit}, dealId: {deal_id}")
-        send_telegram_message(f"📈 Orden {action.upper()} ejecutada para {symbol} a {entry_price} con SL {initial_stop_loss} y TP {take_profit} (dealId: {deal_id})")
-        
-        open_positions[symbol] = {
-            "direction": action.upper(),
-            "entry_price": entry_price,
-            "stop_loss": initial_stop_loss,
-            "dealId": deal_id,
-            "quantity": adjusted_quantity,
-            "spread_at_open": spread,
-            "source": source,
-            "take_profit": take_profit,
-            "highest_price": entry_price,
-            "lowest_price": entry_price,
-            "trailing_active": False,
-            "currency": "USD" if symbol == "EURUSD" else ("MXN" if symbol == "USDMXN" else "CAD")
-        }
-        save_positions(open_positions)
-        
-        return {"message": "Orden ejecutada correctamente"}
+        return await asyncio.to_thread(run_with_local_state, process_trade_signal, action, symbol, quantity, source, loss_amount_usd, background_tasks)
     except Exception as e:
         logger.error(f"Error en la ejecución: {e}")
         send_telegram_message(f"❌ Error en la ejecución: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-async def monitor_trailing_stop():
-    global open_positions
+@app.get("/analytics")
+async def analytics(symbol: str = None, source: str = None, since: float = None):
+    journal = load_journal()
+    closes = journal[journal["event"] == b"close"]
+    if symbol is not None:
+        closes = closes[closes["symbol"] == symbol.encode()]
+    if source is not None:
+        closes = closes[closes["source"] == source.encode()]
+    if since is not None:
+        closes = closes[closes["timestamp"] >= since]
+    # Los cierres sin P&L conocido no cuentan para las estadísticas
+    closes = closes[~np.isnan(closes["pnl_usd"])]
+    pnl = np.asarray(closes["pnl_usd"])
+    return {
+        "events": int(len(journal)),
+        "trades": int(len(closes)),
+        "by_symbol": summarize_trades(closes["symbol"], pnl),
+        "by_source": summarize_trades(closes["source"], pnl)
+    }
+
+@app.get("/portfolio")
+async def portfolio_summary():
+    return {
+        "total_exposure_usd": round(portfolio.total_exposure_usd, 2),
+        "total_upl_usd": round(portfolio.total_upl_usd, 2),
+        "positions": {
+            symbol: {"exposure_usd": round(exposure_usd, 2), "upl_usd": round(upl_usd, 2)}
+            for symbol, (exposure_usd, upl_usd) in portfolio.positions.items()
+        }
+    }
+
+def start_monitor():
+    global open_positions, activity_cursor
     cst, x_security_token = authenticate()
-    logger.setLevel(logging.INFO)
-    logger.info("Iniciando monitoreo de trailing stop...")
-    
-    open_positions = load_positions()
+    if not restore_state():
+        open_positions = load_positions()
+        activity_cursor = load_activity_cursor()
     if open_positions is None:
         open_positions = {}
     logger.info(f"Posiciones abiertas cargadas: {len(open_positions)} posiciones")
+    return cst, x_security_token
+
+def monitor_tick(cst: str, x_security_token: str):
+    cst, x_security_token = sync_open_positions(cst, x_security_token)
+    logger.info(f"Posiciones abiertas sincronizadas: {len(open_positions)} posiciones")
     
-    while True:
-        try:
-            cst, x_security_token = sync_open_positions(cst, x_security_token)
-            logger.info(f"Posiciones abiertas sincronizadas: {len(open_positions)} posiciones")
-            
-            if not open_positions:
-                logger.info("No hay posiciones abiertas para monitorear")
-                await asyncio.sleep(15)
+    if not open_positions:
+        logger.info("No hay posiciones abiertas para monitorear")
+        return cst, x_security_token
+    
+    # Una consulta de mercado por lote y una evaluación vectorizada para todas las posiciones
+    symbols = list(open_positions.keys())
+    quotes = get_market_snapshots(cst, x_security_token, symbols)
+    states, actions = evaluate_position_rules(open_positions, quotes)
+    logger.info(f"Reglas evaluadas para {len(quotes)} posiciones: {len(states)} con trailing actualizado, {len(actions)} acciones {actions}")
+    
+    # Solo las acciones que llaman al bróker toman el lock del símbolo
+    for symbol, action in actions.items():
+        with shared_state.lease(f"symbol:{symbol}", SYMBOL_LOCK_TTL, SYMBOL_LOCK_TIMEOUT):
+            # El webhook pudo haber cerrado o reabierto la posición mientras tanto
+            load_shared_state()
+            pos = open_positions.get(symbol)
+            if pos is None or pos["dealId"] != action["dealId"]:
                 continue
-            
-            for symbol in list(open_positions.keys()):
-                min_size, current_bid, current_offer, spread, min_stop_distance, min_limit_distance, max_stop_distance = get_market_details(cst, x_security_token, symbol)
-                pos = open_positions[symbol]
-                quantity = pos["quantity"]
-                leverage = 100.0
-                upl = pos["upl"]  # Usar el valor de upl de la sincronización
-
-                # Calcular profit manualmente para depuración
-                calculated_profit = calculate_current_profit(pos, current_bid, current_offer)
-                logger.info(f"Comparación para {symbol}: upl={upl} USD (de API), calculated_profit={calculated_profit} USD (manual)")
-
-                # Usar upl como profit_usd
-                profit_usd = upl
-
-                # Actualizar precios máximo y mínimo alcanzados
-                pos["highest_price"] = max(pos["highest_price"], current_bid if pos["direction"] == "BUY" else current_offer)
-                pos["lowest_price"] = min(pos["lowest_price"], current_bid if pos["direction"] == "BUY" else current_offer)
-
-                # Todos los pares (USDCAD, USDMXN, EURUSD) usan 5 decimales
-                pip_value = 0.00001
-                decimal_places = 5
-
-                current_bid = round(current_bid, decimal_places)
-                current_offer = round(current_offer, decimal_places)
-
-                logger.info(f"Monitoreando {symbol}: direction={pos['direction']}, entry_price={pos['entry_price']}, current_bid={current_bid}, current_offer={current_offer}, stop_loss={pos['stop_loss']}, profit_usd={profit_usd}, quantity={quantity}, leverage={leverage}, min_stop_distance={min_stop_distance}, stop_loss_for_0_usd={pos['entry_price']}")
-
-                # Lógica para source="volatility"
-                if pos["source"] == "volatility":
-                    # Mover stop loss a 0 dólares de pérdida cuando la ganancia alcance 10 dólares
-                    if profit_usd >= 10.0 and pos["stop_loss"] != pos["entry_price"]:
-                        new_stop_loss = pos["entry_price"]
-                        if pos["direction"] == "BUY":
-                            max_allowed_stop_loss = current_bid - min_stop_distance
-                            new_stop_loss = min(new_stop_loss, max_allowed_stop_loss)
-                        else:  # SELL
-                            min_allowed_stop_loss = current_offer + min_stop_distance
-                            new_stop_loss = max(new_stop_loss, min_allowed_stop_loss)
-                        new_stop_loss = round(new_stop_loss, decimal_places)
-                        if (pos["direction"] == "BUY" and new_stop_loss > pos["stop_loss"]) or (pos["direction"] == "SELL" and new_stop_loss < pos["stop_loss"]):
-                            try:
-                                update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
-                                pos["stop_loss"] = new_stop_loss
-                                logger.info(f"Stop loss ajustado a 0 dólares de pérdida para {symbol}: {new_stop_loss}, profit_usd={profit_usd}")
-                                send_telegram_message(f"🔄 Stop loss ajustado a 0 dólares de pérdida para {symbol}: {new_stop_loss}, profit: +${profit_usd} USD")
-                            except Exception as e:
-                                logger.error(f"Error al actualizar stop loss: {e}")
-                                send_telegram_message(f"❌ Error al actualizar stop loss para {symbol}: {str(e)}")
-
-                    # Activar trailing stop loss a 3 dólares de distancia cuando la ganancia alcance 13 dólares
-                    if profit_usd >= 13.0:
-                        pos["trailing_active"] = True
-
-                    if pos["trailing_active"]:
-                        trailing_distance = (3.0 * leverage) / quantity  # Distancia para 3 dólares
-                        if pos["direction"] == "BUY":
-                            new_stop_loss = pos["highest_price"] - trailing_distance
-                            max_allowed_stop_loss = current_bid - min_stop_distance
-                            new_stop_loss = min(new_stop_loss, max_allowed_stop_loss)
-                            new_stop_loss = round(new_stop_loss, decimal_places)
-                            if new_stop_loss > pos["stop_loss"]:
-                                try:
-                                    update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
-                                    pos["stop_loss"] = new_stop_loss
-                                    logger.info(f"Trailing stop actualizado para {symbol} (BUY): {new_stop_loss}, profit_usd={profit_usd}")
-                                    send_telegram_message(f"🔄 Trailing stop actualizado para {symbol} (BUY): {new_stop_loss}, profit: +${profit_usd} USD")
-                                except Exception as e:
-                                    if "error.invalid.stoploss.maxvalue" in str(e):
-                                        error_msg = str(e)
-                                        max_allowed_value = float(error_msg.split(": ")[-1].strip("}"))
-                                        adjusted_min_stop_distance = current_bid - max_allowed_value
-                                        logger.warning(f"Ajustando min_stop_distance a {adjusted_min_stop_distance} basado en el error: {e}")
-                                        max_allowed_stop_loss = max_allowed_value
-                                        new_stop_loss = min(new_stop_loss, max_allowed_stop_loss)
-                                        new_stop_loss = round(new_stop_loss, decimal_places)
-                                        update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
-                                        pos["stop_loss"] = new_stop_loss
-                                        logger.info(f"Trailing stop actualizado con ajuste para {symbol} (BUY): {new_stop_loss}, profit_usd={profit_usd}")
-                                        send_telegram_message(f"🔄 Trailing stop actualizado con ajuste para {symbol} (BUY): {new_stop_loss}, profit: +${profit_usd} USD")
-                                    else:
-                                        logger.error(f"Error al actualizar stop loss: {e}")
-                                        send_telegram_message(f"❌ Error al actualizar stop loss para {symbol}: {str(e)}")
-                        else:  # SELL
-                            new_stop_loss = pos["lowest_price"] + trailing_distance
-                            min_allowed_stop_loss = current_offer + min_stop_distance
-                            new_stop_loss = max(new_stop_loss, min_allowed_stop_loss)
-                            new_stop_loss = round(new_stop_loss, decimal_places)
-                            if new_stop_loss < pos["stop_loss"]:
-                                try:
-                                    update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
-                                    pos["stop_loss"] = new_stop_loss
-                                    logger.info(f"Trailing stop actualizado para {symbol} (SELL): {new_stop_loss}, profit_usd={profit_usd}")
-                                    send_telegram_message(f"🔄 Trailing stop actualizado para {symbol} (SELL): {new_stop_loss}, profit: +${profit_usd} USD")
-                                except Exception as e:
-                                    if "error.invalid.stoploss.minvalue" in str(e):
-                                        error_msg = str(e)
-                                        min_allowed_value = float(error_msg.split(": ")[-1].strip("}"))
-                                        adjusted_min_stop_distance = min_allowed_value - current_offer
-                                        logger.warning(f"Ajustando min_stop_distance a {adjusted_min_stop_distance} basado en el error: {e}")
-                                        min_allowed_stop_loss = min_allowed_value
-                                        new_stop_loss = max(new_stop_loss, min_allowed_stop_loss)
-                                        new_stop_loss = round(new_stop_loss, decimal_places)
-                                        update_stop_loss(cst, x_security_token, pos["dealId"], new_stop_loss, symbol)
-                                        pos["stop_loss"] = new_stop_loss
-                                        logger.info(f"Trailing stop actualizado con ajuste para {symbol} (SELL): {new_stop_loss}, profit_usd={profit_usd}")
-                                        send_telegram_message(f"🔄 Trailing stop actualizado con ajuste para {symbol} (SELL): {new_stop_loss}, profit: +${profit_usd} USD")
-                                    else:
-                                        logger.error(f"Error al actualizar stop loss: {e}")
-                                        send_telegram_message(f"❌ Error al actualizar stop loss para {symbol}: {str(e)}")
-                    else:
-                        logger.info(f"No se actualiza trailing stop para {symbol}: profit_usd={profit_usd} < 13.0 USD o trailing no activo")
+            pos.update(states.get(symbol, {}))
+            try:
+                apply_position_action(cst, x_security_token, symbol, pos, action, quotes[symbol])
+            except Exception as e:
+                logger.error(f"Error al aplicar {action['type']} para {symbol}: {e}")
+                send_telegram_message(f"❌ Error al gestionar la posición de {symbol}: {str(e)}")
+            save_positions(open_positions)
+    # Extremos y trailing de todas las posiciones: una sola escritura por iteración
+    if states:
+        save_position_states(states)
+    logger.info(f"Portafolio: exposición={round(portfolio.total_exposure_usd, 2)} USD, upl={round(portfolio.total_upl_usd, 2)} USD")
+    return cst, x_security_token
 
-                # Lógica para source="no cons" (reintroducida temporalmente para depuración)
-                if pos["source"] == "no cons":
-                    if pos["take_profit"] is None:
-                        logger.warning(f"Take profit no definido para {symbol}, source='no cons'. Posición: {pos}")
-                    else:
-                        current_price = current_bid if pos["direction"] == "BUY" else current_offer
-                        target_profit = 3.0  # 3 USD para todos los símbolos
-                        profit_usd_calculated = calculate_current_profit(pos, current_bid, current_offer)
-                        logger.info(f"Verificando take profit para {symbol}: direction={pos['direction']}, current_price={current_price}, take_profit={pos['take_profit']}, profit_usd={profit_usd}, profit_usd_calculated={profit_usd_calculated}, target_profit={target_profit}")
-                        if pos["direction"] == "BUY" and current_price >= pos["take_profit"]:
-                            deal_ref = close_position(cst, x_security_token, pos["dealId"], symbol, pos["quantity"])
-                            profit_loss = target_profit  # Ganancia objetivo
-                            profit_loss_message = f"+${profit_loss} USD"
-                            send_telegram_message(f"🔒 Posición cerrada por take profit para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia: {profit_loss_message}")
-                            logger.info(f"Posición cerrada por take profit para {symbol}, profit_loss: {profit_loss} USD")
-                            del open_positions[symbol]
-                        elif pos["direction"] == "SELL" and current_price <= pos["take_profit"]:
-                            deal_ref = close_position(cst, x_security_token, pos["dealId"], symbol, pos["quantity"])
-                            profit_loss = target_profit  # Ganancia objetivo
-                            profit_loss_message = f"+${profit_loss} USD"
-                            send_telegram_message(f"🔒 Posición cerrada por take profit para {symbol}: {pos['direction']} a {pos['entry_price']}. Ganancia: {profit_loss_message}")
-                            logger.info(f"Posición cerrada por take profit para {symbol}, profit_loss: {profit_loss} USD")
-                            del open_positions[symbol]
-                
-                save_positions(open_positions)
+async def monitor_trailing_stop():
+    logger.setLevel(logging.INFO)
+    logger.info("Iniciando monitoreo de trailing stop...")
+    # Cada iteración corre en un hilo para que el monitoreo no frene la recepción de webhooks
+    cst, x_security_token = await asyncio.to_thread(run_with_local_state, start_monitor)
+    
+    while True:
+        # Renovar el liderazgo; si otro worker lo tomó, dejar de monitorear
+        if not await asyncio.to_thread(shared_state.try_acquire, "monitor", WORKER_ID, MONITOR_LEASE_TTL):
+            logger.warning(f"Worker {WORKER_ID} perdió el liderazgo del monitoreo")
+            return
+        try:
+            cst, x_security_token = await asyncio.to_thread(run_with_local_state, monitor_tick, cst, x_security_token)
             await asyncio.sleep(15)
         except Exception as e:
             logger.error(f"Error en monitor_trailing_stop: {e}")
-            send_telegram_message(f"❌ Error en monitoreo de trailing stop: {str(e)}")
+            if isinstance(e, BrokerError) and e.transient:
+                # El circuit breaker ya avisa por Telegram al degradarse y al recuperarse la API
+                await asyncio.sleep(max(broker_circuit.retry_after(), 15))
+                continue
+            await asyncio.to_thread(send_telegram_message, f"❌ Error en monitoreo de trailing stop: {str(e)}")
             await asyncio.sleep(60)
 
+async def run_monitor_when_leader():
+    while True:
+        if await asyncio.to_thread(shared_state.try_acquire, "monitor", WORKER_ID, MONITOR_LEASE_TTL):
+            logger.info(f"Worker {WORKER_ID} elegido líder del monitoreo")
+            try:
+                await monitor_trailing_stop()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error al iniciar el monitoreo en worker {WORKER_ID}: {e}")
+                await asyncio.to_thread(shared_state.release, "monitor", WORKER_ID)
+        await asyncio.sleep(MONITOR_LEASE_TTL / 4)
+
 if __name__ == "__main__":
-    asyncio.run(monitor_trailing_stop())
\ No newline at end of file
+    asyncio.run(run_monitor_when_leader())
\ No newline at end of file